@@ -1,12 +1,21 @@
 import typing
+import importlib
 import quart
 
-from . import cats
-from . import pokemon
-from . import accounts
-
-blueprints: typing.Tuple[quart.Blueprint] = (
-    cats.cats,
-    pokemon.pokemon,
-    accounts.accounts,
+# module names, each defines a blueprint of the same name
+BLUEPRINTS: typing.Tuple[str, ...] = (
+    "cats",
+    "pokemon",
+    "accounts",
 )
+
+def __getattr__(name: str) -> typing.Any:
+    # blueprints are only imported once the app asks for them, so tools like loader.py can
+    # use endpoints.pokemon without cdn and the other blueprints reading the app's files
+    if name == "blueprints":
+        global blueprints
+        blueprints = tuple(getattr(importlib.import_module(f".{m}", __name__), m) for m in BLUEPRINTS)
+        return blueprints
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+blueprints: typing.Tuple[quart.Blueprint, ...]
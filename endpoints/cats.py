@@ -24,4 +24,4 @@ cats.endpoints = (random_cat,)
 
 @cats.before_app_first_request
 async def before_app_first_request():
-    cats.app.ratelimiter.set_limit("/api/cats/random_cat", 3, 1)
+    cats.app.ratelimiter.set_limit("/api/cats/random", 3, 1)
@@ -3,11 +3,20 @@ import quart
 import typing
 import utils
 import json
+import math
 import aiosqlite
+import numpy
 
+from . import types
 from . types import Types
 from .abilities import Abilities
 from .moves import Moves
+from .snapshot import Snapshot, etag_of
+from .query import Query, QueryError, STAT_COLUMNS, RARITIES, FIELDS, parse_fields
+from .names import NameIndex, COMPLETIONS
+from . import aggregates
+from . import database
+from . import catalog
 
 pokemon = quart.Blueprint(
     "pokemon",
@@ -15,90 +24,389 @@ pokemon = quart.Blueprint(
     url_prefix = "/api/pokemon",
 )
 
+NAME_INDEXES: typing.Dict[str, NameIndex] = {
+    "move": NameIndex(Moves.__items__),
+    "ability": NameIndex(Abilities.__items__),
+}
+
+CATALOGS: typing.Dict[str, catalog.Catalog] = {
+    "moves": catalog.Catalog(Moves),
+    "abilities": catalog.Catalog(Abilities),
+    "types": catalog.Catalog(Types),
+}
+
+async def load_snapshot() -> Snapshot:
+    return await database.reload(pokemon.app)
+
+async def is_admin(api_key: typing.Optional[str]) -> bool:
+    if not api_key:
+        return False
+    async with pokemon.app.account_db.execute(
+        """SELECT key_type
+        FROM accounts
+        WHERE api_key = ?
+        """,
+        (api_key,)
+    ) as cur:
+        d = await cur.fetchone()
+        return bool(d) and d[0] == 10
+
+@pokemon.route("/reload", methods = ("POST",))
+async def reload_data():
+    if not await is_admin(quart.request.headers.get("api_key")):
+        utils.abort_json(403, {"message": "Only admins can reload the pokemon data."})
+    snapshot = await load_snapshot()
+    return {"message": "Success!", "pokemon": len(snapshot)}
+
+@pokemon.route("/pool")
+async def pool_stats():
+    return pokemon.app.pokemon_db.stats()
+
 @pokemon.route("/")
 @pokemon.route("/<name_or_id>")
 async def root(name_or_id: typing.Optional[str] = None):
-    db = pokemon.app.pokemon_db
+    snapshot: Snapshot = pokemon.app.pokemon_snapshot
     if not name_or_id:
         return {"message": "Please provide a valid name or id"}
     name_or_id = str(name_or_id)
     if name_or_id.isdecimal():
         identifier = "id"
     else: identifier = "name"
-    async with db.execute(
-        f"""SELECT name, height, weight, types, abilities, moves, base_exp, hp, attack, defense, special_attack, special_defense, speed, rarity, capture_rate
-        FROM pokemon
-        WHERE {identifier} = ?
-        """,
-        (name_or_id,)
-    ) as cur:
-        d = await cur.fetchone()
-        if not d:
-            utils.abort_json(404, {"message": f"Pokemon with {identifier} {name_or_id!r} was not found on the server."})
-        stats = {
-            "hp": d[7], "attack": d[8],
-            "defense": d[9], "special_attack": d[10],
-            "special_defense": d[11], "speed": d[12],
-        }
-        moves = Moves(int(d[5]))._get_enabled_flags()
-        moves.append("return")
-        rarity = ("normal", "legendary", "mythical")[d[13]]
-        return {
-            "name": d[0],
-            "height": d[1],
-            "weight": d[2],
-            "types": Types(int(d[3]))._get_enabled_flags(),
-            "abilities": Abilities(int(d[4]))._get_enabled_flags(),
-            "moves": moves,
-            "base_experience": d[6],
-            "stats": stats,
-            "rarity": rarity,
-            "capture_rate": d[14],
-        }
+    fields = quart.request.args.get("fields")
+    if fields:
+        try:
+            fields = parse_fields(fields)
+        except QueryError as err:
+            utils.abort_json(400, {"message": str(err)})
+        i = snapshot.find(name_or_id)
+        cached = None if i is None else json.dumps(snapshot.to_json(i, fields)).encode()
+        if cached is not None:
+            cached = (cached, etag_of(cached))
+    else:
+        cached = snapshot.response(name_or_id)
+    if cached is None:
+        err = {"message": f"Pokemon with {identifier} {name_or_id!r} was not found on the server."}
+        if identifier == "name":
+            err["suggestions"] = snapshot.name_index.fuzzy(name_or_id, 3)
+        utils.abort_json(404, err)
+    body, etag = cached
+    resp = quart.Response(body, 200, content_type = "application/json")
+    resp.set_etag(etag)
+    return resp
+
+
+def rows_to_json(rows: typing.Sequence[typing.Sequence[typing.Any]], q: Query) -> typing.List[typing.Dict[str, typing.Any]]:
+    # rows are laid out as q.columns, flags are only decoded when their field was asked for
+    at = {c: i for i, c in enumerate(q.columns)}
+    decoded = {
+        f: cls.decode_many(d[at[f]] for d in rows)
+        for f, cls in (("types", Types), ("abilities", Abilities), ("moves", Moves))
+        if f in q.fields
+    }
+    results = []
+    for n, d in enumerate(rows):
+        ret = {}
+        for f in q.fields:
+            if f in decoded:
+                ret[f] = decoded[f][n]
+                if f == "moves":
+                    ret[f].append("return")
+            elif f == "stats":
+                ret[f] = {c: d[at[c]] for c in STAT_COLUMNS}
+            elif f == "rarity":
+                ret[f] = RARITIES[d[at["rarity"]]]
+            else:
+                ret[f] = d[at[FIELDS[f][0]]]
+        results.append(ret)
+    return results
 
+STREAM_CHUNK = 256
+
+async def stream_rows(q: Query) -> typing.AsyncGenerator[bytes, None]:
+    # every chunk is its own keyset query, so no pooled connection is held while the client reads
+    remaining = q.limit
+    while remaining is None or remaining > 0:
+        q.limit = STREAM_CHUNK if remaining is None else min(remaining, STREAM_CHUNK)
+        sql, params = q.build()
+        async with pokemon.app.pokemon_db.execute(sql, params) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            break
+        yield b"".join(json.dumps(r).encode() + b"\n" for r in rows_to_json(rows, q))
+        if len(rows) < q.limit:
+            break
+        if remaining is not None:
+            remaining -= len(rows)
+        q.after = q.position(rows[-1])
 
 @pokemon.route("/search")
 async def search():
     req = quart.request
-    args = req.args
-    limit = args.get("limit", 20)
-    if len(args) > 0:
-        dc = ("limit",)
-        checks = "WHERE " + (" AND ".join((f"{k} = {v!r}" for k, v in args.items() if k not in dc)))
-    else: checks = ""
-    async with pokemon.app.pokemon_db.execute(
-        f"""SELECT name, height, weight, types, abilities, moves, base_exp, hp, attack, defense, special_attack, special_defense, speed, rarity, capture_rate
-        FROM pokemon
-        {checks}
-        """
-    ) as cursor:
-        results = []
-        for d in await cursor.fetchmany(limit):
-            stats = {
-                "hp": d[7], "attack": d[8],
-                "defense": d[9], "special_attack": d[10],
-                "special_defense": d[11], "speed": d[12],
-            }
-            moves = Moves(int(d[5]))._get_enabled_flags()
-            moves.append("return")
-            rarity = ("normal", "legendary", "mythical")[d[13]]
-            results.append({
-                "name": d[0],
-                "height": d[1],
-                "weight": d[2],
-                "types": Types(int(d[3]))._get_enabled_flags(),
-                "abilities": Abilities(int(d[4]))._get_enabled_flags(),
-                "moves": moves,
-                "base_experience": d[6],
-                "stats": stats,
-                "rarity": rarity,
-                "capture_rate": d[14],
-            })
-        return await utils.send_json(200, results)
-
-pokemon.endpoints = (root, search,)
+    stream = req.args.get("stream") in ("1", "true") or "application/x-ndjson" in req.headers.get("Accept", "")
+    try:
+        q = Query(req.args, stream = stream)
+    except QueryError as err:
+        utils.abort_json(400, {"message": str(err)})
+    if stream:
+        return quart.Response(stream_rows(q), 200, content_type = "application/x-ndjson")
+    sql, params = q.build()
+    async with pokemon.app.pokemon_db.execute(sql, params) as cursor:
+        rows = await cursor.fetchall()
+    resp = await utils.send_json(200, rows_to_json(rows, q))
+    if len(rows) == q.limit:
+        resp.headers["X-Next-Cursor"] = q.encode_cursor(rows[-1])
+    return resp
+
+@pokemon.route("/autocomplete")
+async def autocomplete():
+    args = quart.request.args
+    q = args.get("q", "")
+    kind = args.get("kind", "pokemon")
+    if kind == "pokemon":
+        index = pokemon.app.pokemon_snapshot.name_index
+    elif kind in NAME_INDEXES:
+        index = NAME_INDEXES[kind]
+    else:
+        utils.abort_json(400, {"message": f"kind must be one of pokemon, {', '.join(NAME_INDEXES)}."})
+    try:
+        limit = min(max(int(args.get("limit", COMPLETIONS)), 1), COMPLETIONS)
+    except ValueError:
+        utils.abort_json(400, {"message": "limit must be an integer."})
+    if not q.strip():
+        return {"results": []}
+    return {"results": index.complete(q, limit)}
+
+@pokemon.route("/stats")
+async def stats():
+    snapshot: Snapshot = pokemon.app.pokemon_snapshot
+    args = quart.request.args
+    group_by = args.get("group_by", "none")
+    if group_by not in aggregates.GROUP_BY:
+        utils.abort_json(400, {"message": f"group_by must be one of {', '.join(aggregates.GROUP_BY)}."})
+    try:
+        bins = min(max(int(args.get("bins", 10)), 1), aggregates.MAX_BINS)
+    except ValueError:
+        utils.abort_json(400, {"message": "bins must be an integer."})
+    body = snapshot.stats(group_by, bins)
+    resp = quart.Response(body, 200, content_type = "application/json")
+    resp.set_etag(etag_of(body))
+    return resp
+
+SIMILAR_MAX = 50
+
+@pokemon.route("/<name_or_id>/similar")
+async def similar(name_or_id: str):
+    snapshot: Snapshot = pokemon.app.pokemon_snapshot
+    args = quart.request.args
+    i = snapshot.find(name_or_id)
+    if i is None:
+        utils.abort_json(404, {"message": f"Pokemon {name_or_id!r} was not found on the server."})
+    try:
+        k = min(max(int(args.get("k", 10)), 1), SIMILAR_MAX)
+        weights = {c: float(args.get(c, 0)) for c in ("types", "abilities", "moves")}
+    except ValueError:
+        utils.abort_json(400, {"message": "k must be an integer and types, abilities and moves must be numbers."})
+    if not all(math.isfinite(w) and w >= 0 for w in weights.values()):
+        utils.abort_json(400, {"message": "types, abilities and moves must be finite and not negative."})
+    top, dist = snapshot.stat_space.nearest(i, k, weights)
+    return {
+        "name": snapshot.names[i],
+        "results": [
+            {
+                "id": int(snapshot.columns["id"][j]),
+                "name": snapshot.names[j],
+                "distance": round(float(d), 4),
+            } for j, d in zip(top, dist)
+        ],
+    }
+
+RANDOM_MAX = 100
+
+@pokemon.route("/random")
+async def random_pokemon():
+    r"""<div class="endpoint_card">
+        <h3> /api/pokemon/random </h3>
+        Returns a random pokemon, weighted by rarity and capture rate.
+    </div>
+    """
+    snapshot: Snapshot = pokemon.app.pokemon_snapshot
+    args = quart.request.args
+    try:
+        count = int(args.get("count", 1))
+        rarity = args.get("rarity")
+        if rarity is not None:
+            rarity = RARITIES.index(rarity) if rarity in RARITIES else int(rarity)
+    except ValueError:
+        utils.abort_json(400, {"message": "count and rarity must be integers."})
+    if not 1 <= count <= RANDOM_MAX:
+        utils.abort_json(400, {"message": f"count must be between 1 and {RANDOM_MAX}."})
+    bits = []
+    for name in args.get("type", "").split(","):
+        if not name.strip():
+            continue
+        bit = Types.bit_of(name)
+        if bit is None:
+            utils.abort_json(400, {"message": f"Unknown type {name!r}."})
+        bits.append(bit)
+    key = (tuple(sorted(bits)), rarity)
+    table = snapshot.samplers.get(key)
+    if table is None:
+        mask = numpy.ones(len(snapshot), dtype = bool)
+        if bits:
+            ids = snapshot.inverted.query("types", bits)
+            mask &= numpy.isin(snapshot.columns["id"], ids)
+        if rarity is not None:
+            mask &= snapshot.columns["rarity"] == rarity
+        table = snapshot.sampler(key, numpy.flatnonzero(mask))
+    if len(table) == 0:
+        utils.abort_json(404, {"message": "No pokemon match these filters."})
+    bodies = [snapshot.response_at(int(i))[0] for i in table.draw(count)]
+    if "count" not in args:
+        return quart.Response(bodies[0], 200, content_type = "application/json")
+    return quart.Response(b"[" + b", ".join(bodies) + b"]", 200, content_type = "application/json")
+
+BATCH_MAX = 100
+BATCH_PER_WEIGHT = 10
+
+async def batch_items(req: quart.Request, key: str = "pokemon", limit: int = BATCH_MAX, noun: str = "batch") -> typing.List[str]:
+    if req.method == "POST":
+        d = await req.get_json(silent = True)
+        if isinstance(d, dict):
+            d = d.get(key)
+        if not isinstance(d, list):
+            utils.abort_json(400, {"message": "Expected a json list of pokemon names or ids."})
+        items = [str(i) for i in d]
+    else:
+        items = [i for i in req.args.get(key, "").split(",") if i]
+    if len(items) > limit:
+        utils.abort_json(400, {"message": f"A {noun} can only have a maximum of {limit} pokemon."})
+    return items
+
+async def batch_weight(req: quart.Request) -> int:
+    # a whole batch costs one request per BATCH_PER_WEIGHT pokemon
+    return -(-len(await batch_items(req)) // BATCH_PER_WEIGHT)
+
+@pokemon.route("/batch", methods = ("GET", "POST",))
+async def batch():
+    snapshot: Snapshot = pokemon.app.pokemon_snapshot
+    items = await batch_items(quart.request)
+    bodies = []
+    for item in items:
+        cached = snapshot.response(item)
+        if cached is None:
+            bodies.append(json.dumps({"not_found": item}).encode())
+        else:
+            bodies.append(cached[0])
+    return quart.Response(b"[" + b", ".join(bodies) + b"]", 200, content_type = "application/json")
+
+TEAM_MAX = 6
+
+@pokemon.route("/matchup", methods = ("GET", "POST",))
+async def matchup():
+    snapshot: Snapshot = pokemon.app.pokemon_snapshot
+    team = await batch_items(quart.request, "team", TEAM_MAX, "team")
+    if not team:
+        utils.abort_json(400, {"message": "Please provide a team of pokemon names or ids."})
+    found = []
+    for item in team:
+        i = snapshot.find(item)
+        if i is None:
+            utils.abort_json(404, {"message": f"Pokemon {item!r} was not found on the server."})
+        found.append(i)
+    masks = Types.bit_matrix(snapshot.flags["types"][i] for i in found).astype(bool)
+    taken = types.defensive(masks)
+    dealt = types.offensive(masks)
+    best = dealt.max(axis = 0)
+    bits = [Types.bit_of(t) for t in types.BATTLE_TYPES]
+    return {
+        "team": [snapshot.names[i] for i in found],
+        "defensive": {
+            t: {
+                "multipliers": taken[:, b].tolist(),
+                "weak": int((taken[:, b] > 1).sum()),
+                "resist": int(((taken[:, b] < 1) & (taken[:, b] > 0)).sum()),
+                "immune": int((taken[:, b] == 0).sum()),
+            } for t, b in zip(types.BATTLE_TYPES, bits)
+        },
+        "offensive": {
+            "super_effective": int((best > 1).sum()),
+            "neutral": int((best == 1).sum()),
+            "not_very_effective": int((best < 1).sum()),
+            "combinations": [
+                {"types": list(combo), "best": float(m)} for combo, m in zip(types.COMBOS, best)
+            ],
+        },
+    }
+
+def catalog_response(kind: str) -> quart.Response:
+    args = quart.request.args
+    prefix = args.get("prefix", "").strip().lower().replace("-", "_").replace(" ", "_")
+    try:
+        offset = max(int(args.get("offset", 0)), 0)
+        limit = args.get("limit")
+        if limit is not None:
+            limit = min(max(int(limit), 1), catalog.MAX_LIMIT)
+    except ValueError:
+        utils.abort_json(400, {"message": "offset and limit must be integers."})
+    body, etag = CATALOGS[kind].get(prefix, offset, limit)
+    resp = quart.Response(body, 200, content_type = "application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = catalog.CACHE_CONTROL
+    return resp
+
+@pokemon.route("/moves")
+async def moves_catalog():
+    return catalog_response("moves")
+
+@pokemon.route("/abilities")
+async def abilities_catalog():
+    return catalog_response("abilities")
+
+@pokemon.route("/types")
+async def types_catalog():
+    return catalog_response("types")
+
+def flag_members(column: str, cls: typing.Type[utils.Flags], kind: str, name: str):
+    snapshot: Snapshot = pokemon.app.pokemon_snapshot
+    args = quart.request.args
+    bits = {"all": [], "any": []}
+    for group, names in (("all", [name] + args.get("all", "").split(",")), ("any", args.get("any", "").split(","))):
+        for n in names:
+            if not n.strip():
+                continue
+            bit = cls.bit_of(n)
+            if bit is None:
+                utils.abort_json(404, {"message": f"{kind.capitalize()} {n!r} was not found on the server."})
+            bits[group].append(bit)
+    ids = snapshot.inverted.query(column, bits["all"], bits["any"])
+    return {
+        "count": len(ids),
+        "pokemon": [
+            {"id": int(pid), "name": snapshot.names[snapshot.by_id[int(pid)]]} for pid in ids
+        ],
+    }
+
+@pokemon.route("/moves/<move>/learners")
+async def move_learners(move: str):
+    return flag_members("moves", Moves, "move", move)
+
+@pokemon.route("/abilities/<ability>/holders")
+async def ability_holders(ability: str):
+    return flag_members("abilities", Abilities, "ability", ability)
+
+@pokemon.route("/types/<type_name>/members")
+async def type_members(type_name: str):
+    return flag_members("types", Types, "type", type_name)
+
+pokemon.endpoints = (root, reload_data, pool_stats, search, autocomplete, random_pokemon, similar, stats, batch, matchup, moves_catalog, abilities_catalog, types_catalog, move_learners, ability_holders, type_members,)
 
 @pokemon.before_app_first_request
 async def before_app_first_request():
     pokemon.app.ratelimiter.set_limit("/api/pokemon", 5, 1)
     pokemon.app.ratelimiter.set_limit("/api/pokemon/search", 2, 1)
+    # sized so a full batch (weight BATCH_MAX / BATCH_PER_WEIGHT) fits in one bucket
+    pokemon.app.ratelimiter.set_limit("/api/pokemon/batch", BATCH_MAX // BATCH_PER_WEIGHT, 1)
+    pokemon.app.ratelimiter.set_limit("/api/pokemon/random", 3, 1)
+    pokemon.app.ratelimiter.set_limit("/api/pokemon/stats", 2, 1)
+    pokemon.app.ratelimiter.set_limit("/api/pokemon/matchup", 2, 1)
+    pokemon.app.ratelimiter.set_weight("/api/pokemon/batch", batch_weight)
@@ -0,0 +1,51 @@
+import typing
+import numpy
+
+PERCENTILES: typing.Tuple[int, ...] = (5, 25, 50, 75, 95)
+GROUP_BY: typing.Tuple[str, ...] = ("none", "type", "rarity")
+MAX_BINS = 50
+
+
+def describe(
+    matrix: numpy.ndarray,
+    columns: typing.Sequence[str],
+    edges: typing.Sequence[numpy.ndarray],
+) -> typing.Dict[str, typing.Any]:
+    # one row per pokemon, one column per stat
+    if len(matrix) == 0:
+        return {"count": 0, "stats": {}}
+    mean = matrix.mean(axis = 0)
+    std = matrix.std(axis = 0)
+    lo = matrix.min(axis = 0)
+    hi = matrix.max(axis = 0)
+    pct = numpy.percentile(matrix, PERCENTILES, axis = 0)
+    stats = {}
+    for j, c in enumerate(columns):
+        counts, _ = numpy.histogram(matrix[:, j], bins = edges[j])
+        stats[c] = {
+            "mean": round(float(mean[j]), 2),
+            "std": round(float(std[j]), 2),
+            "min": int(lo[j]),
+            "max": int(hi[j]),
+            "percentiles": {str(p): float(pct[n, j]) for n, p in enumerate(PERCENTILES)},
+            "histogram": {
+                "edges": [round(float(e), 2) for e in edges[j]],
+                "counts": counts.tolist(),
+            },
+        }
+    return {"count": len(matrix), "stats": stats}
+
+def aggregate(
+    matrix: numpy.ndarray,
+    columns: typing.Sequence[str],
+    groups: typing.Dict[str, numpy.ndarray],
+    bins: int,
+) -> typing.Dict[str, typing.Any]:
+    # bin edges come from the whole dex so every group's histogram lines up
+    edges = [
+        numpy.histogram_bin_edges(matrix[:, j], bins = bins) if len(matrix) else numpy.arange(bins + 1)
+        for j in range(matrix.shape[1])
+    ]
+    return {
+        "groups": {name: describe(matrix[mask], columns, edges) for name, mask in groups.items()},
+    }
@@ -0,0 +1,43 @@
+import typing
+import json
+import bisect
+
+import utils
+from .snapshot import etag_of
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+CACHE_CONTROL = "public, max-age=86400"
+
+
+class Catalog:
+
+    __slots__ = ("names", "fragments", "body", "etag")
+
+    def __init__(self, cls: typing.Type[utils.Flags]):
+        items = sorted(cls.__items__.items())
+        self.names: typing.List[str] = [name for name, _ in items]
+        # every entry is serialized once, pages are just joins of these
+        self.fragments: typing.List[bytes] = [
+            json.dumps({"name": name, "bit": value.bit_length() - 1}).encode()
+            for name, value in items
+        ]
+        self.body: bytes = self.page(0, len(self.fragments), 0, len(self.fragments))
+        self.etag: str = etag_of(self.body)
+
+    def page(self, lo: int, hi: int, offset: int, limit: int) -> bytes:
+        start = min(lo + offset, hi)
+        return (
+            b'{"count": ' + str(hi - lo).encode()
+            + b', "results": [' + b", ".join(self.fragments[start:min(start + limit, hi)]) + b"]}"
+        )
+
+    def get(self, prefix: str = "", offset: int = 0, limit: typing.Optional[int] = None) -> typing.Tuple[bytes, str]:
+        if not prefix and offset == 0 and limit is None:
+            return self.body, self.etag
+        lo, hi = 0, len(self.names)
+        if prefix:
+            lo = bisect.bisect_left(self.names, prefix)
+            hi = bisect.bisect_left(self.names, prefix + "￿", lo)
+        body = self.page(lo, hi, offset, DEFAULT_LIMIT if limit is None else limit)
+        return body, etag_of(body)
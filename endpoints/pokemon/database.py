@@ -0,0 +1,84 @@
+import os
+import typing
+import asyncio
+import aiosqlite
+import quart
+
+import utils
+from . import query
+from .snapshot import Snapshot
+from .pool import ConnectionPool
+
+POKEMON_DB = "data/pokemon/pokemon.sqlite"
+# one reader per core, sqlite drops the GIL while it runs a query
+POOL_SIZE = max(min(os.cpu_count() or 1, 8), 2)
+# how often the database files are checked for changes
+WATCH_INTERVAL = 10
+
+_reload_lock: typing.Optional[asyncio.Lock] = None
+# asyncio only keeps weak references to tasks, these close pools that were swapped out
+_closing: typing.Set[asyncio.Task] = set()
+
+
+async def setup_db(path: str = POKEMON_DB):
+    db = await aiosqlite.connect(path)
+    try:
+        await db.execute(query.TABLE)
+        for index in query.INDEXES:
+            await db.execute(index)
+        await db.commit()
+    finally:
+        await db.close()
+
+async def open_db(path: str = POKEMON_DB) -> ConnectionPool:
+    return await ConnectionPool(path, POOL_SIZE, on_connect = query.register_functions).open()
+
+def data_mtime(path: str = POKEMON_DB) -> float:
+    # writes in WAL mode only touch the -wal file until a checkpoint
+    mtime = 0.0
+    for p in (path, f"{path}-wal"):
+        try:
+            mtime = max(mtime, os.stat(p).st_mtime)
+        except FileNotFoundError:
+            pass
+    return mtime
+
+async def reload(app: quart.Quart, path: str = POKEMON_DB) -> Snapshot:
+    global _reload_lock
+    if _reload_lock is None:
+        _reload_lock = asyncio.Lock()
+    async with _reload_lock:
+        # taken before reading, so a write that lands while the snapshot builds is seen by watch()
+        mtime = data_mtime(path)
+        db = await open_db(path)
+        try:
+            snapshot = await Snapshot.load(db)
+            await utils.run_async(snapshot.warm)
+        except BaseException:
+            await db.close()
+            raise
+        old = getattr(app, "pokemon_db", None)
+        # nothing awaits between these, so every request sees either the old pair or the new one
+        app.pokemon_db = db
+        app.pokemon_snapshot = snapshot
+        app.pokemon_mtime = mtime
+        if old is not None:
+            # returns once requests still using the old pool hand their connections back
+            task = asyncio.create_task(old.close())
+            _closing.add(task)
+            task.add_done_callback(_closing.discard)
+        return snapshot
+
+async def watch(app: quart.Quart, path: str = POKEMON_DB):
+    while True:
+        await asyncio.sleep(WATCH_INTERVAL)
+        mtime = data_mtime(path)
+        if mtime <= app.pokemon_mtime:
+            continue
+        try:
+            await reload(app, path)
+            print("Reloaded pokemon data!")
+        except Exception as err:
+            # wait for the next change instead of retrying a broken file
+            app.pokemon_mtime = mtime
+            print(f"Reloading pokemon data failed: {err!r}")
@@ -0,0 +1,56 @@
+import typing
+import numpy
+
+import utils
+
+
+class InvertedIndex:
+
+    __slots__ = ("postings",)
+
+    def __init__(
+        self,
+        ids: numpy.ndarray,
+        columns: typing.Dict[str, typing.Tuple[typing.Type[utils.Flags], typing.Sequence[int]]],
+    ):
+        # column -> bit -> sorted array of the pokemon ids with that bit set
+        self.postings: typing.Dict[str, typing.Tuple[numpy.ndarray, ...]] = {}
+        for column, (cls, values) in columns.items():
+            nbits = cls.__width__ * 8
+            if len(values) == 0 or nbits == 0:
+                self.postings[column] = tuple(ids[:0] for _ in range(nbits))
+                continue
+            bits, rows = numpy.nonzero(cls.bit_matrix(values).T)
+            splits = numpy.searchsorted(bits, numpy.arange(1, nbits))
+            postings = []
+            for p in numpy.split(ids[rows], splits):
+                p.flags.writeable = False
+                postings.append(p)
+            self.postings[column] = tuple(postings)
+
+    def get(self, column: str, bit: int) -> numpy.ndarray:
+        return self.postings[column][bit]
+
+    def query(
+        self,
+        column: str,
+        all_bits: typing.Sequence[int],
+        any_bits: typing.Sequence[int] = (),
+    ) -> numpy.ndarray:
+        postings = self.postings[column]
+        sets = [postings[b] for b in all_bits]
+        if any_bits:
+            union = postings[any_bits[0]]
+            for b in any_bits[1:]:
+                union = numpy.union1d(union, postings[b])
+            sets.append(union)
+        if not sets:
+            return numpy.empty(0, dtype = numpy.int64)
+        # intersect smallest first so every step shrinks the working set
+        sets.sort(key = len)
+        result = sets[0]
+        for s in sets[1:]:
+            if len(result) == 0:
+                break
+            result = numpy.intersect1d(result, s, assume_unique = True)
+        return result
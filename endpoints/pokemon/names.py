@@ -0,0 +1,78 @@
+import typing
+import collections
+
+COMPLETIONS = 10
+
+
+def normalize(name: str) -> str:
+    return name.strip().lower().replace("-", "_").replace(" ", "_")
+
+def trigrams(key: str) -> typing.Set[str]:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+
+    __slots__ = (
+        "names",
+        "keys",
+        "trie",
+        "grams",
+        "sizes",
+    )
+
+    def __init__(self, names: typing.Iterable[str]):
+        self.names: typing.Tuple[str, ...] = tuple(sorted(set(n for n in names if n), key = normalize))
+        self.keys: typing.Tuple[str, ...] = tuple(normalize(n) for n in self.names)
+        # each trie node is (children, first COMPLETIONS name indexes below it)
+        self.trie: typing.Tuple[typing.Dict[str, typing.Any], typing.List[int]] = ({}, [])
+        self.grams: typing.Dict[str, typing.List[int]] = collections.defaultdict(list)
+        self.sizes: typing.List[int] = []
+        for i, key in enumerate(self.keys):
+            node = self.trie
+            for ch in key:
+                if len(node[1]) < COMPLETIONS:
+                    node[1].append(i)
+                node = node[0].setdefault(ch, ({}, []))
+            if len(node[1]) < COMPLETIONS:
+                node[1].append(i)
+            grams = trigrams(key)
+            self.sizes.append(len(grams))
+            for g in grams:
+                self.grams[g].append(i)
+        self.grams = dict(self.grams)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def prefix(self, query: str, limit: int = COMPLETIONS) -> typing.List[str]:
+        node = self.trie
+        for ch in normalize(query):
+            node = node[0].get(ch)
+            if node is None:
+                return []
+        return [self.names[i] for i in node[1][:limit]]
+
+    def fuzzy(self, query: str, limit: int = COMPLETIONS, threshold: float = 0.3) -> typing.List[str]:
+        grams = trigrams(normalize(query))
+        shared = collections.Counter()
+        for g in grams:
+            shared.update(self.grams.get(g, ()))
+        scored = []
+        for i, n in shared.items():
+            score = n / (len(grams) + self.sizes[i] - n)
+            if score >= threshold:
+                scored.append((-score, i))
+        scored.sort()
+        return [self.names[i] for _, i in scored[:limit]]
+
+    def complete(self, query: str, limit: int = COMPLETIONS) -> typing.List[str]:
+        found = self.prefix(query, limit)
+        if len(found) < limit:
+            for n in self.fuzzy(query, limit):
+                if n not in found:
+                    found.append(n)
+                    if len(found) == limit:
+                        break
+        return found
@@ -0,0 +1,89 @@
+import typing
+import asyncio
+import contextlib
+import aiosqlite
+
+
+class ConnectionPool:
+
+    def __init__(
+        self,
+        path: str,
+        size: int,
+        immutable: bool = False,
+        mmap_size: int = 256 * 1024 * 1024,
+        on_connect: typing.Optional[typing.Callable[[aiosqlite.Connection], typing.Awaitable[None]]] = None,
+    ):
+        self.path: str = path
+        self.size: int = max(size, 1)
+        # immutable skips all locking, only safe if the file is replaced rather than written to
+        self.immutable: bool = immutable
+        self.mmap_size: int = mmap_size
+        self.on_connect = on_connect
+        self.connections: typing.List[aiosqlite.Connection] = []
+        self.free: typing.Optional[asyncio.Queue] = None
+        self.waiting: int = 0
+        self.acquired: int = 0
+        self.peak: int = 0
+        self.closed: bool = False
+
+    async def open(self) -> "ConnectionPool":
+        self.free = asyncio.Queue()
+        uri = f"file:{self.path}?mode=ro" + ("&immutable=1" if self.immutable else "")
+        try:
+            for _ in range(self.size):
+                db = await aiosqlite.connect(uri, uri = True)
+                self.connections.append(db)
+                await db.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+                if self.on_connect is not None:
+                    await self.on_connect(db)
+                self.free.put_nowait(db)
+        except BaseException:
+            for db in self.connections:
+                await db.close()
+            raise
+        return self
+
+    @property
+    def in_use(self) -> int:
+        return self.size - self.free.qsize()
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "size": self.size,
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "utilization": round(self.in_use / self.size, 3),
+            "peak_in_use": self.peak,
+            "acquired": self.acquired,
+        }
+
+    @contextlib.asynccontextmanager
+    async def acquire(self) -> typing.AsyncIterator[aiosqlite.Connection]:
+        if self.closed:
+            raise ValueError("Connection pool is closed")
+        self.waiting += 1
+        try:
+            db = await self.free.get()
+        finally:
+            self.waiting -= 1
+        self.acquired += 1
+        self.peak = max(self.peak, self.in_use)
+        try:
+            yield db
+        finally:
+            self.free.put_nowait(db)
+
+    @contextlib.asynccontextmanager
+    async def execute(self, sql: str, parameters: typing.Iterable[typing.Any] = ()) -> typing.AsyncIterator[aiosqlite.Cursor]:
+        async with self.acquire() as db:
+            async with db.execute(sql, parameters) as cursor:
+                yield cursor
+
+    async def close(self):
+        # waits for every connection to be handed back, so in-flight queries finish first
+        self.closed = True
+        for _ in range(len(self.connections)):
+            db = await self.free.get()
+            await db.close()
+        self.connections.clear()
@@ -0,0 +1,253 @@
+import typing
+import json
+import base64
+import binascii
+import functools
+import aiosqlite
+
+import utils
+from .types import Types
+from .abilities import Abilities
+from .moves import Moves
+
+# columns that can be filtered and sorted on, with the type their values are parsed as
+COLUMNS: typing.Dict[str, type] = {
+    "id": int,
+    "name": str,
+    "height": int,
+    "weight": int,
+    "rarity": int,
+    "capture_rate": int,
+    "base_exp": int,
+    "hp": int,
+    "attack": int,
+    "defense": int,
+    "special_attack": int,
+    "special_defense": int,
+    "speed": int,
+}
+OPERATORS: typing.Dict[str, str] = {
+    "eq": "=",
+    "ne": "!=",
+    "gt": ">",
+    "gte": ">=",
+    "lt": "<",
+    "lte": "<=",
+}
+STAT_COLUMNS: typing.Tuple[str, ...] = (
+    "hp", "attack", "defense",
+    "special_attack", "special_defense", "speed",
+)
+RARITIES: typing.Tuple[str, ...] = ("normal", "legendary", "mythical")
+# response field -> the columns it is built from, in response order
+FIELDS: typing.Dict[str, typing.Tuple[str, ...]] = {
+    "name": ("name",),
+    "height": ("height",),
+    "weight": ("weight",),
+    "types": ("types",),
+    "abilities": ("abilities",),
+    "moves": ("moves",),
+    "base_experience": ("base_exp",),
+    "stats": STAT_COLUMNS,
+    "rarity": ("rarity",),
+    "capture_rate": ("capture_rate",),
+}
+# flag filters, resolved through the flag classes and evaluated with has_flag()
+FLAG_FILTERS: typing.Dict[str, typing.Tuple[str, typing.Type[utils.Flags]]] = {
+    "type": ("types", Types),
+    "ability": ("abilities", Abilities),
+    "move": ("moves", Moves),
+}
+RESERVED: typing.Tuple[str, ...] = ("limit", "order_by", "cursor", "fields", "stream")
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+# types, abilities and moves are fixed-width little-endian blobs, see utils.Flags.to_bytes
+TABLE_SCHEMA = "(id INT, name TEXT, description LONGTEXT, height INT, weight INT, rarity INT, capture_rate INT, types BLOB, abilities BLOB, moves BLOB, base_exp INT, hp INT, attack INT, defense INT, special_attack INT, special_defense INT, speed INT)"
+TABLE = f"CREATE TABLE IF NOT EXISTS pokemon {TABLE_SCHEMA}"
+TABLE_COLUMNS: typing.Tuple[str, ...] = (
+    "id", "name", "description", "height", "weight", "rarity", "capture_rate",
+    "types", "abilities", "moves", "base_exp",
+    "hp", "attack", "defense", "special_attack", "special_defense", "speed",
+)
+
+# every sortable column gets a (column, id) index so keyset pages are a range seek
+INDEX_NAMES: typing.Tuple[str, ...] = tuple(f"pokemon_{c}" for c in COLUMNS)
+INDEXES: typing.Tuple[str, ...] = tuple(
+    f"CREATE INDEX IF NOT EXISTS pokemon_{c} ON pokemon ({c}, id)" if c != "id"
+    else "CREATE INDEX IF NOT EXISTS pokemon_id ON pokemon (id)"
+    for c in COLUMNS
+)
+
+
+class QueryError(ValueError):
+    pass
+
+
+def is_column_value(value: typing.Any, kind: type) -> bool:
+    if kind is int:
+        # bool is an int subclass, and sqlite integers are 64 bit
+        return type(value) is int and -(1 << 63) <= value < (1 << 63)
+    return type(value) is kind
+
+
+_to_int = functools.lru_cache(maxsize = 4096)(utils.Flags.from_db)
+
+def has_flag(value: typing.Union[bytes, str, int, None], bit: int) -> bool:
+    return (_to_int(value) >> bit) & 1 == 1
+
+def flag_count(value: typing.Union[bytes, str, int, None]) -> int:
+    return bin(_to_int(value)).count("1")
+
+def flags_intersect(value: typing.Union[bytes, str, int, None], mask: typing.Union[str, int]) -> bool:
+    return _to_int(value) & int(mask) != 0
+
+# masks wider than 64 bits have to be bound as decimal text
+FUNCTIONS: typing.Tuple[typing.Tuple[str, int, typing.Callable], ...] = (
+    ("has_flag", 2, has_flag),
+    ("flag_count", 1, flag_count),
+    ("flags_intersect", 2, flags_intersect),
+)
+
+def parse_fields(value: typing.Optional[str]) -> typing.Tuple[str, ...]:
+    if not value:
+        return tuple(FIELDS)
+    wanted = {f.strip() for f in value.split(",") if f.strip()}
+    unknown = wanted.difference(FIELDS)
+    if unknown:
+        raise QueryError(f"Unknown field {sorted(unknown)[0]!r}.")
+    return tuple(f for f in FIELDS if f in wanted)
+
+async def register_functions(db: aiosqlite.Connection):
+    for name, nargs, func in FUNCTIONS:
+        await db.create_function(name, nargs, func, deterministic = True)
+
+
+class Query:
+
+    __slots__ = (
+        "where",
+        "params",
+        "order_by",
+        "descending",
+        "limit",
+        "after",
+        "fields",
+        "columns",
+    )
+
+    def __init__(self, args: typing.Mapping[str, str], stream: bool = False):
+        self.where: typing.List[str] = []
+        self.params: typing.List[typing.Any] = []
+        self.after: typing.Optional[typing.Tuple[typing.Any, int]] = None
+
+        order_by = args.get("order_by", "id")
+        self.descending: bool = order_by.startswith("-")
+        self.order_by: str = order_by[1:] if self.descending else order_by
+        if self.order_by not in COLUMNS:
+            raise QueryError(f"Cannot order by {self.order_by!r}.")
+
+        try:
+            # streams are read in keyset chunks and never held in memory, so they have no cap
+            # and return every match unless a limit is given
+            if stream:
+                self.limit: typing.Optional[int] = max(int(args["limit"]), 1) if "limit" in args else None
+            else:
+                self.limit = min(max(int(args.get("limit", DEFAULT_LIMIT)), 1), MAX_LIMIT)
+        except ValueError:
+            raise QueryError("limit must be an integer.")
+
+        for k, v in args.items():
+            if k in RESERVED:
+                continue
+            self.add_filter(k, v)
+
+        if "cursor" in args:
+            self.after = self.decode_cursor(args["cursor"])
+
+        self.fields: typing.Tuple[str, ...] = parse_fields(args.get("fields"))
+        # only select what the fields need, plus what the cursor is built from
+        columns = [c for f in self.fields for c in FIELDS[f]]
+        for c in (self.order_by, "id"):
+            if c not in columns:
+                columns.append(c)
+        self.columns: typing.Tuple[str, ...] = tuple(columns)
+
+    def add_filter(self, key: str, value: str):
+        if key in FLAG_FILTERS:
+            return self.add_flag_filter(key, value)
+        column, _, op = key.partition("__")
+        if column not in COLUMNS:
+            raise QueryError(f"Cannot search by {column!r}.")
+        if op not in OPERATORS and op != "":
+            raise QueryError(f"Unknown operator {op!r}.")
+        try:
+            value = COLUMNS[column](value)
+        except ValueError:
+            raise QueryError(f"{column} must be of type {COLUMNS[column].__name__}.")
+        self.where.append(f"{column} {OPERATORS.get(op, '=')} ?")
+        self.params.append(value)
+
+    def add_flag_filter(self, key: str, value: str):
+        column, cls = FLAG_FILTERS[key]
+        for name in value.split(","):
+            if not name.strip():
+                continue
+            bit = cls.bit_of(name)
+            if bit is None:
+                raise QueryError(f"Unknown {key} {name!r}.")
+            self.where.append(f"has_flag({column}, ?)")
+            self.params.append(bit)
+
+    def decode_cursor(self, cursor: str) -> typing.Tuple[typing.Any, int]:
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError, binascii.Error):
+            raise QueryError("Invalid cursor.")
+        if not isinstance(payload, list) or len(payload) != 4:
+            raise QueryError("Invalid cursor.")
+        order_by, descending, value, last_id = payload
+        if order_by != self.order_by or descending != self.descending:
+            raise QueryError("Cursor does not match order_by.")
+        # cursors come from clients, so only values sqlite can bind for this column get through
+        if not (value is None or is_column_value(value, COLUMNS[self.order_by])) or not is_column_value(last_id, int):
+            raise QueryError("Invalid cursor.")
+        return value, last_id
+
+    def position(self, row: typing.Sequence[typing.Any]) -> typing.Tuple[typing.Any, int]:
+        return row[self.columns.index(self.order_by)], row[self.columns.index("id")]
+
+    def encode_cursor(self, row: typing.Sequence[typing.Any]) -> str:
+        value, last_id = self.position(row)
+        return base64.urlsafe_b64encode(
+            json.dumps([self.order_by, self.descending, value, last_id]).encode()
+        ).decode()
+
+    def build(self) -> typing.Tuple[str, typing.Tuple[typing.Any, ...]]:
+        where = list(self.where)
+        params = list(self.params)
+        cmp = "<" if self.descending else ">"
+        direction = "DESC" if self.descending else "ASC"
+        if self.after is not None:
+            if self.order_by == "id":
+                where.append(f"id {cmp} ?")
+                params.append(self.after[1])
+            else:
+                where.append(f"({self.order_by}, id) {cmp} (?, ?)")
+                params.extend(self.after)
+        if self.order_by == "id":
+            order = f"id {direction}"
+        else:
+            order = f"{self.order_by} {direction}, id {direction}"
+        checks = ("WHERE " + " AND ".join(where)) if where else ""
+        # a negative limit is no limit in sqlite
+        params.append(-1 if self.limit is None else self.limit)
+        return (
+            f"""SELECT {', '.join(self.columns)}
+            FROM pokemon
+            {checks}
+            ORDER BY {order}
+            LIMIT ?
+            """,
+            tuple(params),
+        )
@@ -0,0 +1,43 @@
+import typing
+import numpy
+
+# how much less likely legendary and mythical pokemon are to be drawn
+RARITY_WEIGHTS: typing.Tuple[float, ...] = (1.0, 0.1, 0.02)
+
+rng = numpy.random.default_rng()
+
+
+class AliasTable:
+
+    __slots__ = ("items", "prob", "alias")
+
+    def __init__(self, items: numpy.ndarray, weights: numpy.ndarray):
+        # Vose's alias method, O(n) to build and O(1) per draw
+        n = len(items)
+        self.items: numpy.ndarray = items
+        self.prob: numpy.ndarray = numpy.ones(n)
+        self.alias: numpy.ndarray = numpy.arange(n)
+        total = weights.sum()
+        if n == 0 or total <= 0:
+            return
+        scaled = weights * (n / total)
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def draw(self, count: int = 1) -> numpy.ndarray:
+        i = rng.integers(len(self.items), size = count)
+        keep = rng.random(count) < self.prob[i]
+        return self.items[numpy.where(keep, i, self.alias[i])]
+
+
+def weights_of(rarity: numpy.ndarray, capture_rate: numpy.ndarray) -> numpy.ndarray:
+    return numpy.maximum(capture_rate, 1) * numpy.asarray(RARITY_WEIGHTS)[numpy.clip(rarity, 0, len(RARITY_WEIGHTS) - 1)]
@@ -0,0 +1,52 @@
+import typing
+import numpy
+
+import utils
+
+
+class StatSpace:
+
+    __slots__ = ("stats", "bits", "counts")
+
+    def __init__(
+        self,
+        stats: numpy.ndarray,
+        columns: typing.Dict[str, typing.Tuple[typing.Type[utils.Flags], typing.Sequence[int]]],
+    ):
+        # z-scored stat vectors, so a point of speed weighs the same as a point of hp relative to their spread
+        stats = stats.astype(numpy.float32)
+        std = stats.std(axis = 0)
+        std[std == 0] = 1.0
+        self.stats: numpy.ndarray = (stats - stats.mean(axis = 0)) / std
+        self.bits: typing.Dict[str, numpy.ndarray] = {}
+        self.counts: typing.Dict[str, numpy.ndarray] = {}
+        for column, (cls, values) in columns.items():
+            matrix = cls.bit_matrix(values).astype(bool)
+            self.bits[column] = matrix
+            self.counts[column] = matrix.sum(axis = 1)
+
+    def jaccard(self, column: str, index: int) -> numpy.ndarray:
+        matrix = self.bits[column]
+        mine = numpy.flatnonzero(matrix[index])
+        inter = matrix[:, mine].sum(axis = 1)
+        union = self.counts[column] + len(mine) - inter
+        return numpy.divide(inter, union, out = numpy.zeros(len(matrix)), where = union > 0)
+
+    def nearest(
+        self,
+        index: int,
+        k: int,
+        weights: typing.Mapping[str, float] = {},
+    ) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+        # mean squared z-score difference, plus weighted jaccard distances
+        dist = ((self.stats - self.stats[index]) ** 2).mean(axis = 1)
+        for column, w in weights.items():
+            if w:
+                dist += w * (1.0 - self.jaccard(column, index))
+        dist[index] = numpy.inf
+        k = min(k, len(dist) - 1)
+        if k <= 0:
+            return numpy.empty(0, dtype = numpy.int64), numpy.empty(0)
+        top = numpy.argpartition(dist, k - 1)[:k]
+        top = top[numpy.argsort(dist[top])]
+        return top, dist[top]
@@ -0,0 +1,192 @@
+import typing
+import json
+import hashlib
+import numpy
+import aiosqlite
+
+import utils
+
+from .types import Types
+from .abilities import Abilities
+from .moves import Moves
+from .index import InvertedIndex
+from .names import NameIndex
+from .sampling import AliasTable, weights_of
+from .similarity import StatSpace
+from . import aggregates
+from .query import STAT_COLUMNS, RARITIES, FIELDS
+
+NUMBER_COLUMNS: typing.Tuple[str, ...] = (
+    "id", "height", "weight", "rarity", "capture_rate", "base_exp",
+) + STAT_COLUMNS
+FLAG_COLUMNS: typing.Tuple[typing.Tuple[str, typing.Type[utils.Flags]], ...] = (
+    ("types", Types),
+    ("abilities", Abilities),
+    ("moves", Moves),
+)
+
+MAX_SAMPLERS = 256
+
+
+def etag_of(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size = 16).hexdigest()
+
+
+class Snapshot:
+
+    __slots__ = (
+        "names",
+        "columns",
+        "flags",
+        "decoded",
+        "by_id",
+        "by_name",
+        "responses",
+        "inverted",
+        "name_index",
+        "samplers",
+        "_stat_space",
+        "aggregates",
+    )
+
+    def __init__(self, rows: typing.Sequence[typing.Sequence[typing.Any]]):
+        # rows are (name, types, abilities, moves, *NUMBER_COLUMNS)
+        self.names: typing.Tuple[str, ...] = tuple(r[0] for r in rows)
+        self.columns: typing.Dict[str, numpy.ndarray] = {}
+        for i, c in enumerate(NUMBER_COLUMNS, 4):
+            arr = numpy.array([r[i] or 0 for r in rows], dtype = numpy.int64)
+            arr.flags.writeable = False
+            self.columns[c] = arr
+        self.flags: typing.Dict[str, typing.Tuple[int, ...]] = {}
+        self.decoded: typing.Dict[str, typing.Tuple[typing.Tuple[str, ...], ...]] = {}
+        for i, (c, cls) in enumerate(FLAG_COLUMNS, 1):
+            values = tuple(cls.from_db(r[i]) for r in rows)
+            self.flags[c] = values
+            self.decoded[c] = tuple(tuple(d) for d in cls.decode_many(values))
+        self.by_id: typing.Dict[int, int] = {
+            int(pid): i for i, pid in enumerate(self.columns["id"])
+        }
+        self.by_name: typing.Dict[str, int] = {
+            name.lower(): i for i, name in enumerate(self.names) if name
+        }
+        self.inverted: InvertedIndex = InvertedIndex(
+            self.columns["id"],
+            {c: (cls, self.flags[c]) for c, cls in FLAG_COLUMNS},
+        )
+        self.name_index: NameIndex = NameIndex(self.names)
+        # alias tables for /random, one per filter bucket
+        self.samplers: typing.Dict[typing.Hashable, AliasTable] = {}
+        self._stat_space: typing.Optional[StatSpace] = None
+        # serialized /stats bodies, keyed by (group_by, bins)
+        self.aggregates: typing.Dict[typing.Tuple[str, int], bytes] = {}
+        # serialized body and strong etag, keyed by id and by lowercased name
+        self.responses: typing.Dict[str, typing.Tuple[bytes, str]] = {}
+
+    @classmethod
+    async def load(cls, db: aiosqlite.Connection) -> "Snapshot":
+        async with db.execute(
+            f"""SELECT name, types, abilities, moves, {', '.join(NUMBER_COLUMNS)}
+            FROM pokemon
+            ORDER BY id
+            """
+        ) as cur:
+            rows = await cur.fetchall()
+        return await utils.run_async(cls, rows)
+
+    def warm(self):
+        # fill the lazy caches up front so the first requests after a swap don't pay for them
+        for i in range(len(self)):
+            self.response_at(i)
+        self.stat_space
+        self.stats("none", 10)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def find(self, name_or_id: typing.Union[str, int]) -> typing.Optional[int]:
+        name_or_id = str(name_or_id)
+        if name_or_id.isdecimal():
+            return self.by_id.get(int(name_or_id))
+        return self.by_name.get(name_or_id.lower())
+
+    def to_json(self, index: int, fields: typing.Sequence[str] = tuple(FIELDS)) -> typing.Dict[str, typing.Any]:
+        cols = self.columns
+        ret = {}
+        for f in fields:
+            if f in self.decoded:
+                ret[f] = list(self.decoded[f][index])
+                if f == "moves":
+                    ret[f].append("return")
+            elif f == "name":
+                ret[f] = self.names[index]
+            elif f == "stats":
+                ret[f] = {c: int(cols[c][index]) for c in STAT_COLUMNS}
+            elif f == "rarity":
+                ret[f] = RARITIES[cols["rarity"][index]]
+            else:
+                ret[f] = int(cols[FIELDS[f][0]][index])
+        return ret
+
+    def response(self, name_or_id: typing.Union[str, int]) -> typing.Optional[typing.Tuple[bytes, str]]:
+        key = str(name_or_id).lower()
+        cached = self.responses.get(key)
+        if cached is not None:
+            return cached
+        i = self.find(key)
+        if i is None:
+            return None
+        return self.response_at(i)
+
+    def response_at(self, index: int) -> typing.Tuple[bytes, str]:
+        key = self.names[index].lower()
+        cached = self.responses.get(key)
+        if cached is not None:
+            return cached
+        body = json.dumps(self.to_json(index)).encode()
+        cached = (body, etag_of(body))
+        self.responses[str(int(self.columns["id"][index]))] = cached
+        self.responses[key] = cached
+        return cached
+
+    @property
+    def stat_space(self) -> StatSpace:
+        if self._stat_space is None:
+            self._stat_space = StatSpace(
+                numpy.stack([self.columns[c] for c in STAT_COLUMNS], axis = 1),
+                {c: (cls, self.flags[c]) for c, cls in FLAG_COLUMNS},
+            )
+        return self._stat_space
+
+    def stats(self, group_by: str, bins: int) -> bytes:
+        key = (group_by, bins)
+        body = self.aggregates.get(key)
+        if body is not None:
+            return body
+        cols = self.columns
+        matrix = numpy.stack([cols[c] for c in STAT_COLUMNS], axis = 1)
+        if group_by == "type":
+            bits = Types.bit_matrix(self.flags["types"]).astype(bool)
+            groups = {
+                name: bits[:, Types.bit_of(name)] for name in Types.__items__
+            }
+        elif group_by == "rarity":
+            groups = {r: cols["rarity"] == n for n, r in enumerate(RARITIES)}
+        else:
+            groups = {"all": numpy.ones(len(self), dtype = bool)}
+        groups = {name: mask for name, mask in groups.items() if mask.any()}
+        result = aggregates.aggregate(matrix, STAT_COLUMNS, groups, bins)
+        result["group_by"] = group_by
+        body = self.aggregates[key] = json.dumps(result).encode()
+        return body
+
+    def sampler(self, key: typing.Hashable, indexes: numpy.ndarray) -> AliasTable:
+        table = self.samplers.get(key)
+        if table is None:
+            if len(self.samplers) >= MAX_SAMPLERS:
+                self.samplers.clear()
+            cols = self.columns
+            table = self.samplers[key] = AliasTable(
+                indexes,
+                weights_of(cols["rarity"][indexes], cols["capture_rate"][indexes]),
+            )
+        return table
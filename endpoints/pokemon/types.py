@@ -1,3 +1,6 @@
+import typing
+import numpy
+
 import utils
 
 
@@ -22,3 +25,61 @@ class Types(utils.Flags):
     fairy = 1 << 17
     unknown = 1 << 18
     shadow = 1 << 19
+
+
+# attacking type -> defending types that don't take neutral damage.
+# unknown and shadow are left neutral.
+_CHART: typing.Dict[str, typing.Dict[str, float]] = {
+    "normal": {"rock": 0.5, "ghost": 0, "steel": 0.5},
+    "fighting": {"normal": 2, "flying": 0.5, "poison": 0.5, "rock": 2, "bug": 0.5, "ghost": 0, "steel": 2, "psychic": 0.5, "ice": 2, "dark": 2, "fairy": 0.5},
+    "flying": {"fighting": 2, "rock": 0.5, "bug": 2, "steel": 0.5, "grass": 2, "electric": 0.5},
+    "poison": {"poison": 0.5, "ground": 0.5, "rock": 0.5, "ghost": 0.5, "steel": 0, "grass": 2, "fairy": 2},
+    "ground": {"flying": 0, "poison": 2, "rock": 2, "bug": 0.5, "steel": 2, "fire": 2, "grass": 0.5, "electric": 2},
+    "rock": {"fighting": 0.5, "flying": 2, "ground": 0.5, "bug": 2, "steel": 0.5, "fire": 2, "ice": 2},
+    "bug": {"fighting": 0.5, "flying": 0.5, "poison": 0.5, "ghost": 0.5, "steel": 0.5, "fire": 0.5, "grass": 2, "psychic": 2, "dark": 2, "fairy": 0.5},
+    "ghost": {"normal": 0, "ghost": 2, "psychic": 2, "dark": 0.5},
+    "steel": {"rock": 2, "steel": 0.5, "fire": 0.5, "water": 0.5, "electric": 0.5, "ice": 2, "fairy": 2},
+    "fire": {"rock": 0.5, "bug": 2, "steel": 2, "fire": 0.5, "water": 0.5, "grass": 2, "ice": 2, "dragon": 0.5},
+    "water": {"ground": 2, "rock": 2, "fire": 2, "water": 0.5, "grass": 0.5, "dragon": 0.5},
+    "grass": {"flying": 0.5, "poison": 0.5, "ground": 2, "rock": 2, "bug": 0.5, "steel": 0.5, "fire": 0.5, "water": 2, "grass": 0.5, "dragon": 0.5},
+    "electric": {"flying": 2, "ground": 0, "water": 2, "grass": 0.5, "electric": 0.5, "dragon": 0.5},
+    "psychic": {"fighting": 2, "poison": 2, "steel": 0.5, "psychic": 0.5, "dark": 0},
+    "ice": {"flying": 2, "ground": 2, "steel": 0.5, "fire": 0.5, "water": 0.5, "grass": 2, "ice": 0.5, "dragon": 2},
+    "dragon": {"steel": 0.5, "dragon": 2, "fairy": 0},
+    "dark": {"fighting": 0.5, "ghost": 2, "psychic": 2, "dark": 0.5, "fairy": 0.5},
+    "fairy": {"fighting": 2, "poison": 0.5, "steel": 0.5, "fire": 0.5, "dragon": 2, "dark": 2},
+}
+
+# EFFECTIVENESS[attacking bit, defending bit] is the damage multiplier
+EFFECTIVENESS: numpy.ndarray = numpy.ones((Types.__width__ * 8, Types.__width__ * 8), dtype = numpy.float32)
+for _atk, _row in _CHART.items():
+    for _def, _mult in _row.items():
+        EFFECTIVENESS[Types.bit_of(_atk), Types.bit_of(_def)] = _mult
+EFFECTIVENESS.flags.writeable = False
+
+# every defending combination of the real types, one or two at a time
+BATTLE_TYPES: typing.Tuple[str, ...] = tuple(_CHART)
+COMBOS: typing.Tuple[typing.Tuple[str, ...], ...] = tuple(
+    (a,) if a == b else (a, b)
+    for i, a in enumerate(BATTLE_TYPES)
+    for b in BATTLE_TYPES[i:]
+)
+COMBO_MASKS: numpy.ndarray = Types.bit_matrix(
+    sum(getattr(Types, t) for t in combo) for combo in COMBOS
+).astype(bool)
+# COMBO_EFFECTIVENESS[attacking bit, combo] is the multiplier against that combination
+COMBO_EFFECTIVENESS: numpy.ndarray = numpy.prod(
+    numpy.where(COMBO_MASKS[None, :, :], EFFECTIVENESS[:, None, :], 1), axis = 2
+)
+COMBO_EFFECTIVENESS.flags.writeable = False
+
+
+def defensive(masks: numpy.ndarray) -> numpy.ndarray:
+    # masks is (pokemon, bit) bool, returns (pokemon, attacking bit) multipliers taken
+    return numpy.prod(numpy.where(masks[:, None, :], EFFECTIVENESS[None, :, :], 1), axis = 2)
+
+def offensive(masks: numpy.ndarray) -> numpy.ndarray:
+    # best multiplier the pokemon's own types deal to each combination, shape (pokemon, combo)
+    return numpy.max(
+        numpy.where(masks[:, :, None], COMBO_EFFECTIVENESS[None, :, :], 0), axis = 1
+    )
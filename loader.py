@@ -0,0 +1,221 @@
+import argparse
+import csv
+import json
+import re
+import sqlite3
+import sys
+import time
+import typing
+
+import utils
+from endpoints.pokemon import query
+from endpoints.pokemon.query import RARITIES
+from endpoints.pokemon.snapshot import FLAG_COLUMNS
+
+DB_PATH = "data/pokemon/pokemon.sqlite"
+BATCH_SIZE = 5000
+WHITESPACE = re.compile(r"\s*")
+SEPARATORS = re.compile(r"[\s,]*")
+# alternative names input files use for our columns
+ALIASES: typing.Dict[str, str] = {
+    "base_experience": "base_exp",
+    "sp_attack": "special_attack",
+    "sp_defense": "special_defense",
+}
+
+
+class LoadError(ValueError):
+    pass
+
+
+def read_records(path: str) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+    if path.endswith(".csv"):
+        with open(path, newline = "") as f:
+            yield from csv.DictReader(f)
+    elif path.endswith((".ndjson", ".jsonl")):
+        with open(path) as f:
+            for n, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError as err:
+                        raise LoadError(f"Invalid json on line {n}: {err}")
+    else:
+        with open(path) as f:
+            yield from read_json_list(f)
+
+def read_json_list(f: typing.TextIO, chunk: int = 1 << 16) -> typing.Iterator[typing.Any]:
+    # yields the items of a top level json list one at a time, without reading the whole file
+    decoder = json.JSONDecoder()
+    buf, pos = "", 0
+
+    def skip(pattern: typing.Pattern[str]) -> str:
+        # moves past pattern and returns the next character, reading more when needed
+        nonlocal buf, pos
+        while True:
+            pos = pattern.match(buf, pos).end()
+            if pos < len(buf):
+                return buf[pos]
+            buf, pos = f.read(chunk), 0
+            if not buf:
+                raise LoadError("Unexpected end of the json list")
+
+    if skip(WHITESPACE) != "[":
+        raise LoadError("Expected a json list of pokemon")
+    pos += 1
+    while skip(SEPARATORS) != "]":
+        while True:
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+                break
+            except json.JSONDecodeError as err:
+                # the item runs past the end of what has been read so far
+                more = f.read(chunk)
+                if not more:
+                    raise LoadError(f"Invalid json: {err}")
+                buf, pos = buf[pos:] + more, 0
+        yield item
+
+def encode_flags(cls: typing.Type[utils.Flags], value: typing.Any) -> int:
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        if value.strip().isdecimal():
+            return int(value)
+        value = [v for v in re.split(r"[,;| ]+", value) if v]
+    flags = 0
+    for name in value or ():
+        bit = cls.bit_of(str(name))
+        if bit is None:
+            raise LoadError(f"Unknown {cls.__name__.lower()} {name!r}")
+        flags |= 1 << bit
+    return flags
+
+def to_row(record: typing.Dict[str, typing.Any]) -> typing.Tuple[typing.Any, ...]:
+    record = {ALIASES.get(k, k): v for k, v in record.items()}
+    stats = record.pop("stats", None)
+    if isinstance(stats, dict):
+        for k, v in stats.items():
+            record.setdefault(ALIASES.get(k, k), v)
+    rarity = record.get("rarity") or 0
+    if isinstance(rarity, str):
+        rarity = RARITIES.index(rarity) if rarity in RARITIES else int(rarity)
+    if not 0 <= rarity < len(RARITIES):
+        raise LoadError(f"Unknown rarity {rarity!r}")
+    record["rarity"] = rarity
+    for column, cls in FLAG_COLUMNS:
+        record[column] = cls.to_bytes(encode_flags(cls, record.get(column)))
+    row = []
+    for column in query.TABLE_COLUMNS:
+        value = record.get(column)
+        if value == "":
+            value = None
+        elif value is not None and query.COLUMNS.get(column) is int:
+            value = int(value)
+        row.append(value)
+    if row[0] is None or not row[1]:
+        raise LoadError("Every pokemon needs an id and a name")
+    return tuple(row)
+
+def batches(rows: typing.Iterable[typing.Tuple[typing.Any, ...]], size: int) -> typing.Iterator[typing.List[typing.Tuple[typing.Any, ...]]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def load(path: str, db_path: str = DB_PATH, append: bool = False) -> int:
+    db = sqlite3.connect(db_path, isolation_level = None)
+    try:
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        sql = f"""INSERT INTO pokemon ({', '.join(query.TABLE_COLUMNS)})
+        VALUES ({', '.join('?' * len(query.TABLE_COLUMNS))})
+        """
+        count = 0
+        db.execute("BEGIN")
+        try:
+            db.execute(query.TABLE)
+            # indexes are rebuilt once at the end instead of updated per row
+            for index in query.INDEX_NAMES:
+                db.execute(f"DROP INDEX IF EXISTS {index}")
+            if not append:
+                db.execute("DELETE FROM pokemon")
+            for n, batch in enumerate(batches(read_records(path), BATCH_SIZE)):
+                try:
+                    rows = [to_row(r) for r in batch]
+                except (LoadError, ValueError, TypeError) as err:
+                    raise LoadError(f"Batch starting at record {n * BATCH_SIZE + 1}: {err}")
+                db.executemany(sql, rows)
+                count += len(rows)
+            for index in query.INDEXES:
+                db.execute(index)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("ANALYZE pokemon")
+        return count
+    finally:
+        db.close()
+
+def migrate(db_path: str = DB_PATH) -> int:
+    # rewrites decimal text flag columns as fixed-width blobs, safe to run more than once
+    db = sqlite3.connect(db_path, isolation_level = None)
+    try:
+        db.execute("PRAGMA journal_mode = WAL")
+        for column, cls in FLAG_COLUMNS:
+            db.create_function(f"{column}_blob", 1, cls.to_bytes, deterministic = True)
+        columns = ", ".join(
+            f"{c}_blob({c})" if c in dict(FLAG_COLUMNS) else c for c in query.TABLE_COLUMNS
+        )
+        db.execute("BEGIN")
+        try:
+            db.execute(query.TABLE)
+            db.execute("DROP TABLE IF EXISTS pokemon_migrated")
+            db.execute(f"CREATE TABLE pokemon_migrated {query.TABLE_SCHEMA}")
+            count = db.execute(
+                f"""INSERT INTO pokemon_migrated ({', '.join(query.TABLE_COLUMNS)})
+                SELECT {columns} FROM pokemon
+                """
+            ).rowcount
+            db.execute("DROP TABLE pokemon")
+            db.execute("ALTER TABLE pokemon_migrated RENAME TO pokemon")
+            for index in query.INDEXES:
+                db.execute(index)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("VACUUM")
+        db.execute("ANALYZE pokemon")
+        return count
+    finally:
+        db.close()
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None):
+    parser = argparse.ArgumentParser(description = "Manage the pokemon database.")
+    parser.add_argument("--db", default = DB_PATH, help = f"database to use, defaults to {DB_PATH}")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    load_cmd = commands.add_parser("load", help = "load pokemon from a file")
+    load_cmd.add_argument("file", help = "a .json list, .ndjson/.jsonl or .csv file of pokemon, read incrementally")
+    load_cmd.add_argument("--append", action = "store_true", help = "keep the existing rows instead of replacing them")
+    commands.add_parser("migrate", help = "rewrite the flag columns as binary blobs in place")
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    try:
+        if args.command == "load":
+            count = load(args.file, args.db, args.append)
+            print(f"Loaded {count} pokemon in {time.perf_counter() - start:.2f}s")
+        else:
+            count = migrate(args.db)
+            print(f"Migrated {count} pokemon in {time.perf_counter() - start:.2f}s")
+    except LoadError as err:
+        sys.exit(f"Load failed: {err}")
+
+
+if __name__ == "__main__":
+    main()
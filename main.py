@@ -26,7 +26,10 @@ app.email_app_password = os.environ["email_app_password"]
 app.secret_key = os.environ['secret_key'].encode()
 
 app.loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
-app.ratelimiter: ratelimiter.Ratelimiter = ratelimiter.Ratelimiter(app)
+app.ratelimiter: ratelimiter.Ratelimiter = ratelimiter.Ratelimiter(
+    app,
+    ratelimiter.make_backend(os.environ.get("ratelimit_backend")), # "local", "shm:<path>" or a redis url
+)
 
 
 app.config["dsc_client_id"] = str(os.environ.get("dsc_client_id"))
@@ -62,13 +65,12 @@ async def setup():
             (username TEXT, name TEXT, img_bytes LONGBLOB, created_at DATETIME)
             """
         ): await app.account_db.commit()
-    app.pokemon_db = await aiosqlite.connect("data/pokemon/pokemon.sqlite")
-    async with app.pokemon_db.execute(
-        """CREATE TABLE IF NOT EXISTS pokemon
-        (id INT, name TEXT, description LONGTEXT, height INT, weight INT, rarity INT, capture_rate INT, types LONGTEXT, abilities LONGTEXT, moves LONGTEXT, base_exp INT, hp INT, attack INT, defense INT, special_attack INT, special_defense INT, speed INT)
-        """
-    ): await app.pokemon_db.commit()
+    await app.ratelimiter.setup_quotas()
+    await endpoints.pokemon.database.setup_db()
+    await endpoints.pokemon.load_snapshot()
+    asyncio.create_task(endpoints.pokemon.database.watch(app))
     asyncio.create_task(keep_alive_task())
+    asyncio.create_task(app.ratelimiter.quota_task())
     app.is_setup = True
     print("Done setting up!")
 
@@ -268,30 +270,30 @@ async def before_first_request():
     await setup()
     app.html_files["endpoints.html"] = ""
 
+@app.after_serving
+async def after_serving():
+    if app.is_setup:
+        await app.ratelimiter.flush_quotas()
+
 @app.before_request
 async def before_request():
     req = quart.request
     ses = quart.session
     api_key = req.headers.get("api_key") or ses.get("api_key")
-    rc = await app.ratelimiter.process_request(req.path, api_key)
+    rc = await app.ratelimiter.process_request(app.ratelimiter.match(req), api_key, await app.ratelimiter.weigh(req))
     if rc: utils.abort_json(403, {"message": rc})
     ses.permanent = True
 
 @app.after_request
 async def after_request(response: quart.Response):
+    req = quart.request
+    etag = response.get_etag()[0]
+    if etag and response.status_code == 200 and req.if_none_match.contains(etag):
+        response.status_code = 304
+        response.set_data(b"")
     if response.content_type == "application/json":
-        req = quart.request
-        api_key = req.headers.get("api_key")
-        if api_key:
-            try:
-                r = app.ratelimiter.rules[req.path]
-                rem = app.ratelimiter.cache[req.path][api_key]
-
-                response.headers["X-Ratelimit-Total"] = r[0]
-                response.headers["X-Ratelimit-Remaining"] = rem
-                response.headers["X-Ratelimit-Reset"] = ((r[0] - rem) * r[1])
-            except:
-                pass
+        api_key = req.headers.get("api_key") or quart.session.get("api_key")
+        response.headers.update(await app.ratelimiter.headers(app.ratelimiter.match(req), api_key))
     return response
 
 app.endpoints = ()
@@ -1,55 +1,536 @@
 import quart
 import typing
 import asyncio
+import functools
+import hashlib
+import struct
+import math
+import mmap
+import time
+import os
+
+try:
+    import fcntl
+except ImportError: # not available on windows
+    fcntl = None
+
+# key_type that is never ratelimited
+UNLIMITED_KEY_TYPE = 10
+GLOBAL_RULE = "*"
+# keys untouched for this long are dropped, a bucket idle that long has refilled anyway
+IDLE_TIMEOUT = 60
+# requests a key may make per utc day and month, scaled by key_type like the ratelimits
+DAILY_QUOTA = 10_000
+MONTHLY_QUOTA = 200_000
+# key_type -> (daily, monthly), overrides the scaled defaults
+QUOTAS: typing.Dict[int, typing.Tuple[int, int]] = {}
+# how often quota usage is written to the accounts database
+QUOTA_FLUSH_INTERVAL = 30
+MAX_BUCKETS = 100_000
+MAX_KEY_TYPES = 50_000
+SHARED_SLOTS = 65536
+# how many neighbouring slots a key may land in before the stalest one is reused
+SHARED_PROBE = 16
+
+MISSING = object()
+
+
+class Generations:
+    # two generation sweep: live entries are moved forward on access, whatever is
+    # still in the old generation when it is swept has been idle for a whole interval
+
+    def __init__(self, cap: int):
+        self.cap: int = cap
+        self.current: typing.Dict[typing.Any, typing.Any] = {}
+        self.previous: typing.Dict[typing.Any, typing.Any] = {}
+        self.swept_at: float = time.monotonic()
+        self.evicted: int = 0
+        # entries dropped early because the cap was hit, they may not have been idle
+        self.forced: int = 0
+        self.sweeps: int = 0
+
+    def __len__(self) -> int:
+        return len(self.current) + len(self.previous)
+
+    def get(self, key, default = None):
+        value = self.current.get(key, MISSING)
+        if value is MISSING:
+            value = self.previous.pop(key, MISSING)
+            if value is MISSING:
+                return default
+            self.current[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.previous.pop(key, None)
+        self.current[key] = value
+        if len(self.current) >= self.cap:
+            self.forced += len(self.previous)
+            self.rotate(time.monotonic())
+
+    def rotate(self, now: float):
+        self.evicted += len(self.previous)
+        self.sweeps += 1
+        self.previous = self.current
+        self.current = {}
+        self.swept_at = now
+
+    def sweep(self, now: float, interval: float):
+        if now - self.swept_at >= interval:
+            self.rotate(now)
+
+    def stats(self) -> typing.Dict[str, int]:
+        return {"size": len(self), "evicted": self.evicted, "forced": self.forced, "sweeps": self.sweeps}
+
+
+def refill(tokens: float, ts: float, limit: float, per: float, now: float) -> float:
+    # a timestamp from the future (another worker wrote after our clock was read, a reboot)
+    # refills nothing rather than everything
+    elapsed = max(now - ts, 0.0)
+    return min(limit, tokens + elapsed * limit / per)
+
+def bucket_key(rule: str, api_key: str) -> str:
+    return f"{rule}\0{api_key}"
+
+
+class Backend:
+    # keys are (bucket key, limit, per), take either consumes weight from every bucket or from none
+
+    async def take(self, keys: typing.Sequence[typing.Tuple[str, float, float]], weight: int) -> typing.Optional[int]:
+        # returns the index of the first bucket without enough tokens, None if the request may go through
+        raise NotImplementedError
+
+    async def peek(self, key: str, limit: float, per: float) -> float:
+        raise NotImplementedError
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        return {}
+
+
+class LocalBackend(Backend):
+    # per process, only correct with a single worker
+
+    def __init__(self, cap: int = MAX_BUCKETS):
+        # bucket key -> [tokens, last refill]
+        self.buckets: Generations = Generations(cap)
+        self.longest: float = 0
+
+    def _tokens(self, key: str, limit: float, per: float, now: float) -> float:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return limit
+        return refill(bucket[0], bucket[1], limit, per, now)
+
+    async def take(self, keys, weight):
+        now = time.monotonic()
+        # a bucket idle for longer than the slowest refill is full, so dropping it changes nothing
+        self.longest = max([self.longest] + [per for _, _, per in keys])
+        self.buckets.sweep(now, max(IDLE_TIMEOUT, self.longest))
+        left = []
+        for n, (key, limit, per) in enumerate(keys):
+            tokens = self._tokens(key, limit, per, now)
+            if tokens < weight:
+                return n
+            left.append(tokens - weight)
+        for (key, _, _), tokens in zip(keys, left):
+            self.buckets[key] = [tokens, now]
+        return None
+
+    async def peek(self, key, limit, per):
+        return self._tokens(key, limit, per, time.monotonic())
+
+    def stats(self):
+        return self.buckets.stats()
+
+
+class SharedMemoryBackend(Backend):
+    # a fixed table of (key hash, tokens, last refill) slots in a memory mapped file, shared by
+    # every worker on the host and updated under an exclusive flock. The file outlives the
+    # processes and reboots, so timestamps are wall clock rather than monotonic
+
+    SLOT = struct.Struct("<Qdd")
+
+    def __init__(self, path: str, slots: int = SHARED_SLOTS):
+        if fcntl is None:
+            raise RuntimeError("The shared memory ratelimit backend needs fcntl")
+        self.path: str = path
+        # the probe window never wraps, so the table has SHARED_PROBE spare slots at the end
+        size = (slots + SHARED_PROBE) * self.SLOT.size
+        self.fd: int = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            # another worker may have created the table already, with a different size
+            size = max(os.fstat(self.fd).st_size, size)
+            os.ftruncate(self.fd, size)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.slots: int = size // self.SLOT.size - SHARED_PROBE
+        self.table: mmap.mmap = mmap.mmap(self.fd, size)
+        self.window: struct.Struct = struct.Struct("<" + "Qdd" * SHARED_PROBE)
+        self.evicted: int = 0
+
+    @staticmethod
+    @functools.lru_cache(maxsize = 4096)
+    def hash(key: str) -> int:
+        # 0 marks an empty slot
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size = 8).digest(), "little") or 1
+
+    def _find(self, h: int) -> typing.Tuple[int, float, float, bool]:
+        # (slot, tokens, last refill, found), an empty or the stalest slot if the key isn't there
+        start = h % self.slots
+        slot_hash, tokens, ts = self.SLOT.unpack_from(self.table, start * self.SLOT.size)
+        if slot_hash == h:
+            return start, tokens, ts, True
+        window = self.window.unpack_from(self.table, start * self.SLOT.size)
+        free, oldest = None, None
+        for i in range(0, len(window), 3):
+            slot_hash = window[i]
+            if slot_hash == h:
+                return start + i // 3, window[i + 1], window[i + 2], True
+            if slot_hash == 0:
+                if free is None:
+                    free = start + i // 3
+            elif oldest is None or window[i + 2] < window[oldest * 3 + 2]:
+                oldest = i // 3
+        if free is not None:
+            return free, 0.0, 0.0, False
+        return start + oldest, window[oldest * 3 + 1], window[oldest * 3 + 2], False
+
+    def _take(self, keys, weight):
+        hashes = [self.hash(key) for key, _, _ in keys]
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            # read under the lock, so no other worker can have written a later timestamp
+            now = time.time()
+            left = []
+            for n, (h, (_, limit, per)) in enumerate(zip(hashes, keys)):
+                slot, tokens, ts, found = self._find(h)
+                if found and ts > now:
+                    # the clock was set back, restart the refill from now, even if this request is denied
+                    ts = now
+                    self.SLOT.pack_into(self.table, slot * self.SLOT.size, h, tokens, now)
+                tokens = refill(tokens, ts, limit, per, now) if found else limit
+                if tokens < weight:
+                    return n
+                left.append((slot, found, tokens - weight))
+            claimed = set()
+            for h, (slot, found, tokens) in zip(hashes, left):
+                if not found:
+                    if slot in claimed:
+                        # an earlier key in this request took the same free slot
+                        slot, _, _, found = self._find(h)
+                    if self.SLOT.unpack_from(self.table, slot * self.SLOT.size)[0]:
+                        self.evicted += 1
+                claimed.add(slot)
+                self.SLOT.pack_into(self.table, slot * self.SLOT.size, h, tokens, now)
+            return None
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    async def take(self, keys, weight):
+        return self._take(keys, weight)
+
+    async def peek(self, key, limit, per):
+        h = self.hash(key)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            _, tokens, ts, found = self._find(h)
+            now = time.time()
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return refill(tokens, ts, limit, per, now) if found else limit
+
+    def stats(self):
+        return {"slots": self.slots, "evicted": self.evicted}
+
+    def close(self):
+        self.table.close()
+        os.close(self.fd)
+
+
+# KEYS are the buckets, ARGV is the weight followed by a limit and per for every key
+TAKE_SCRIPT = """
+local t = redis.call("TIME")
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local weight = tonumber(ARGV[1])
+local left = {}
+for i, key in ipairs(KEYS) do
+    local limit, per = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+    local b = redis.call("HMGET", key, "tokens", "ts")
+    local tokens = limit
+    if b[1] and now < tonumber(b[2]) then
+        -- the clock was set back, restart the refill from now, even if this request is denied
+        redis.call("HSET", key, "ts", tostring(now))
+        b[2] = tostring(now)
+    end
+    if b[1] then
+        local elapsed = math.max(now - tonumber(b[2]), 0)
+        tokens = math.min(limit, tonumber(b[1]) + elapsed * limit / per)
+    end
+    if tokens < weight then
+        return i
+    end
+    left[i] = tokens - weight
+end
+for i, key in ipairs(KEYS) do
+    redis.call("HSET", key, "tokens", tostring(left[i]), "ts", tostring(now))
+    -- a bucket left alone for per seconds is full again, so it can just expire
+    redis.call("PEXPIRE", key, math.ceil(tonumber(ARGV[i * 2 + 1]) * 1000))
+end
+return 0
+"""
+
+PEEK_SCRIPT = """
+local t = redis.call("TIME")
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local limit, per = tonumber(ARGV[1]), tonumber(ARGV[2])
+local b = redis.call("HMGET", KEYS[1], "tokens", "ts")
+if not b[1] then
+    return tostring(limit)
+end
+local elapsed = math.max(now - tonumber(b[2]), 0)
+return tostring(math.min(limit, tonumber(b[1]) + elapsed * limit / per))
+"""
+
+
+class RedisBackend(Backend):
+    # shared by every worker and host, client is anything with redis-py's async eval(script, numkeys, *args)
+
+    def __init__(self, client: typing.Any, prefix: str = "ratelimit:"):
+        self.client = client
+        self.prefix: str = prefix
+
+    async def take(self, keys, weight):
+        args = [weight]
+        for _, limit, per in keys:
+            args += [limit, per]
+        denied = int(await self.client.eval(
+            TAKE_SCRIPT, len(keys), *[self.prefix + key for key, _, _ in keys], *args
+        ))
+        return denied - 1 if denied else None
+
+    async def peek(self, key, limit, per):
+        return float(await self.client.eval(PEEK_SCRIPT, 1, self.prefix + key, limit, per))
+
+
+class LocalStore:
+    # in-process stand-in for a redis client that only understands the scripts above
+
+    def __init__(self):
+        self.backend: LocalBackend = LocalBackend()
+
+    async def eval(self, script: str, numkeys: int, *args):
+        keys, argv = args[:numkeys], args[numkeys:]
+        if script == TAKE_SCRIPT:
+            limits = zip(argv[1::2], argv[2::2])
+            denied = await self.backend.take([(k, l, p) for k, (l, p) in zip(keys, limits)], argv[0])
+            return 0 if denied is None else denied + 1
+        if script == PEEK_SCRIPT:
+            return str(await self.backend.peek(keys[0], *argv))
+        raise ValueError("LocalStore can only run the ratelimiter scripts")
+
+
+def make_backend(spec: typing.Optional[str] = None) -> Backend:
+    # "local", "shm:<path>" or a redis url
+    if not spec or spec == "local":
+        return LocalBackend()
+    if spec.startswith("shm:"):
+        return SharedMemoryBackend(spec[4:])
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError(
+                "The redis ratelimit backend needs the redis package (4.2 or newer), install it with pip install redis"
+            )
+        return RedisBackend(redis.asyncio.from_url(spec))
+    raise ValueError(f"Unknown ratelimit backend {spec!r}")
+
 
 class Ratelimiter:
 
-    def __init__(self, app: quart.Quart):
+    def __init__(self, app: quart.Quart, backend: typing.Optional[Backend] = None):
         self.app: quart.Quart = app
-        self.key_types: typing.Dict[str, typing.Any] = {}
+        self.backend: Backend = backend or LocalBackend()
+        # api_key -> key_type, None for keys that don't exist
+        self.key_types: Generations = Generations(MAX_KEY_TYPES)
         self.global_max: int = 50
-        self.globals: typing.Dict[str, int] = {}
+        self.global_per: int = 1
         self.rules: typing.Dict[str, typing.Tuple[int, int]] = {}
-        self.cache: typing.Dict[str, typing.Dict[str, int]] = {}
-
-    def set_limit(self, path, limit, per = 1):
-        self.rules[path] = (limit, per)
-
-    async def process_request(self, path: str, api_key: str):
-        if path not in self.rules: return None
-        if path not in self.cache:
-            self.cache[path] = {api_key: self.rules[path][0]}
-        if api_key not in self.key_types:
-            async with self.app.account_db.execute(
-                """SELECT key_type
-                FROM accounts
-                WHERE api_key = ?
-                """,
-                (api_key,)
-            ) as cur:
-                d = await cur.fetchone()
-                self
-                if not d: return
-                kt = d[0]
-                self.key_types[api_key] = kt
-                if kt == 10:
-                    return
-        else: kt = self.key_types[api_key]
-        if api_key in self.globals:
-            if self.globals[api_key] < 1:
-                return "You have reached the global ratelimit!"
-        path = path.split("?")[0]
-        if api_key in self.cache[path]:
-            if (self.cache[path][api_key] * (kt + 1)) < 1:
-                return "You have reached the ratelimit for this path!"
-        else:
-            self.cache[path][api_key] = self.rules[path][0]
-        self.globals[api_key] = self.globals[api_key] - 1
-        self.cache[path][api_key] = self.cache[path][api_key] - 1
-        asyncio.create_task(self.update_cache(api_key, self.rules[path][1]))
+        # path segment -> subtree, the None key holds the rule ending at that node
+        self.trie: typing.Dict[typing.Optional[str], typing.Any] = {}
+        self.weights: typing.Dict[str, typing.Callable[[quart.Request], typing.Awaitable[int]]] = {}
+        # (api_key, period) -> requests made, period is "YYYY-MM-DD" or "YYYY-MM"
+        self.quota_used: typing.Dict[typing.Tuple[str, str], int] = {}
+        # the part of quota_used that hasn't been written to the database yet
+        self.quota_pending: typing.Dict[typing.Tuple[str, str], int] = {}
+
+    def set_limit(self, rule: str, limit: int, per: int = 1):
+        # rule is a url rule ("/api/accounts/edit/<username>"), an endpoint name ("cats.random_cat")
+        # or a path prefix ("/api/pokemon"), limit requests every per seconds, refilled continuously
+        self.rules[rule] = (limit, per)
+        if rule.startswith("/"):
+            node = self.trie
+            for segment in self.segments(rule):
+                node = node.setdefault(segment, {})
+            node[None] = rule
+
+    @staticmethod
+    def segments(path: str) -> typing.List[str]:
+        return [s for s in path.split("?")[0].split("/") if s]
+
+    def match_path(self, path: str) -> typing.Optional[str]:
+        # longest registered prefix, compared segment by segment
+        node = self.trie
+        rule = node.get(None)
+        for segment in self.segments(path):
+            node = node.get(segment)
+            if node is None:
+                break
+            rule = node.get(None, rule)
+        return rule
+
+    def match(self, req: quart.Request) -> typing.Optional[str]:
+        url_rule = req.url_rule.rule if req.url_rule is not None else None
+        if url_rule in self.rules:
+            return url_rule
+        if req.endpoint in self.rules:
+            return req.endpoint
+        return self.match_path(req.path)
+
+    def set_weight(self, rule: str, weigh: typing.Callable[[quart.Request], typing.Awaitable[int]]):
+        self.weights[rule] = weigh
+
+    async def weigh(self, req: quart.Request) -> int:
+        weigh = self.weights.get(self.match(req))
+        if weigh is None:
+            return 1
+        return max(await weigh(req), 1)
+
+    async def key_type(self, api_key: typing.Optional[str]) -> typing.Optional[int]:
+        if not api_key:
+            return None
+        kt = self.key_types.get(api_key, MISSING)
+        if kt is not MISSING:
+            return kt
+        async with self.app.account_db.execute(
+            """SELECT key_type
+            FROM accounts
+            WHERE api_key = ?
+            """,
+            (api_key,)
+        ) as cur:
+            d = await cur.fetchone()
+        kt = self.key_types[api_key] = d[0] if d else None
+        return kt
+
+    def stats(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        return {"buckets": self.backend.stats(), "key_types": self.key_types.stats()}
+
+    @staticmethod
+    def periods() -> typing.Tuple[str, str]:
+        now = time.gmtime()
+        return time.strftime("%Y-%m-%d", now), time.strftime("%Y-%m", now)
+
+    def quotas(self, kt: int) -> typing.Tuple[int, int]:
+        return QUOTAS.get(kt) or (DAILY_QUOTA * (kt + 1), MONTHLY_QUOTA * (kt + 1))
+
+    async def setup_quotas(self):
+        async with self.app.account_db.execute(
+            """CREATE TABLE IF NOT EXISTS quotas
+            (api_key TEXT, period TEXT, used INTEGER, PRIMARY KEY (api_key, period))
+            """
+        ): await self.app.account_db.commit()
+        await self.load_quotas()
+
+    async def load_quotas(self):
+        # totals for the current periods, plus whatever this process hasn't flushed yet
+        periods = self.periods()
+        async with self.app.account_db.execute(
+            """SELECT api_key, period, used
+            FROM quotas
+            WHERE period IN (?, ?)
+            """,
+            periods
+        ) as cur:
+            used = {(k, p): u for k, p, u in await cur.fetchall()}
+        for key, n in self.quota_pending.items():
+            if key[1] in periods:
+                used[key] = used.get(key, 0) + n
+        self.quota_used = used
+
+    async def flush_quotas(self):
+        pending, self.quota_pending = self.quota_pending, {}
+        if pending:
+            try:
+                # written as increments so several workers can share the table
+                await self.app.account_db.executemany(
+                    """INSERT INTO quotas (api_key, period, used) VALUES (?, ?, ?)
+                    ON CONFLICT (api_key, period) DO UPDATE SET used = used + excluded.used
+                    """,
+                    [(k, p, n) for (k, p), n in pending.items()]
+                )
+                await self.app.account_db.commit()
+            except BaseException:
+                for key, n in pending.items():
+                    self.quota_pending[key] = self.quota_pending.get(key, 0) + n
+                raise
+        # picks up other workers' usage and drops counters from past periods
+        await self.load_quotas()
+
+    async def quota_task(self):
+        while True:
+            await asyncio.sleep(QUOTA_FLUSH_INTERVAL)
+            try:
+                await self.flush_quotas()
+            except Exception as err:
+                print(f"Flushing quotas failed: {err!r}")
+
+    def _limits(self, rule: typing.Tuple[int, int], kt: int) -> typing.Tuple[float, float]:
+        # higher key types get proportionally bigger buckets
+        return rule[0] * (kt + 1), rule[1]
+
+    async def process_request(self, name: typing.Optional[str], api_key: str, weight: int = 1):
+        # name is the rule returned by match()
+        rule = self.rules.get(name)
+        if rule is None: return None
+        self.key_types.sweep(time.monotonic(), IDLE_TIMEOUT)
+        kt = await self.key_type(api_key)
+        if kt is None or kt == UNLIMITED_KEY_TYPE: return None
+        periods = self.periods()
+        for period, quota, span in zip(periods, self.quotas(kt), ("daily", "monthly")):
+            if self.quota_used.get((api_key, period), 0) + weight > quota:
+                return f"You have used up your {span} quota!"
+        g_limit, g_per = self._limits((self.global_max, self.global_per), kt)
+        limit, per = self._limits(rule, kt)
+        # a request can never cost more than a full bucket, rules for weighted paths must be sized for the heaviest request
+        if weight > min(limit, g_limit):
+            return "This request costs more than the ratelimit for this path allows!"
+        denied = await self.backend.take(
+            ((bucket_key(GLOBAL_RULE, api_key), g_limit, g_per), (bucket_key(name, api_key), limit, per)),
+            weight,
+        )
+        if denied == 0:
+            return "You have reached the global ratelimit!"
+        if denied == 1:
+            return "You have reached the ratelimit for this path!"
+        for period in periods:
+            key = (api_key, period)
+            self.quota_used[key] = self.quota_used.get(key, 0) + weight
+            self.quota_pending[key] = self.quota_pending.get(key, 0) + weight
         return None
 
-        async def update_cache(self, api_key, st):
-            await asyncio.sleep(st)
-            self.globals[api_key] = self.globals[api_key] + 1
-            self.cache[path][api_key] + self.cache[path][api_key] + 1
+    async def headers(self, name: typing.Optional[str], api_key: typing.Optional[str]) -> typing.Dict[str, str]:
+        rule = self.rules.get(name)
+        kt = self.key_types.get(api_key) if api_key else None
+        if rule is None or kt is None or kt == UNLIMITED_KEY_TYPE:
+            return {}
+        limit, per = self._limits(rule, kt)
+        tokens = await self.backend.peek(bucket_key(name, api_key), limit, per)
+        daily = self.quotas(kt)[0] - self.quota_used.get((api_key, self.periods()[0]), 0)
+        return {
+            "X-Ratelimit-Total": str(int(limit)),
+            "X-Ratelimit-Remaining": str(max(int(tokens), 0)),
+            "X-Ratelimit-Reset": str(math.ceil((limit - tokens) * per / limit)),
+            "X-Quota-Remaining": str(max(daily, 0)),
+        }
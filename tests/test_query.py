@@ -0,0 +1,40 @@
+import base64
+import json
+
+import pytest
+
+from endpoints.pokemon.query import Query, QueryError
+
+
+def cursor(*payload) -> str:
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def test_cursor_round_trip():
+    q = Query({"order_by": "-hp", "fields": "name"})
+    row = tuple({"name": "mon7", "hp": 50, "id": 7}[c] for c in q.columns)
+    after = Query({"order_by": "-hp", "cursor": q.encode_cursor(row)}).after
+    assert after == (50, 7)
+
+@pytest.mark.parametrize("payload", [
+    ("id", False, 1, [1]),
+    ("id", False, 1, "7"),
+    ("id", False, 1, True),
+    ("id", False, 1, 1 << 64),
+    ("id", False, {"a": 1}, 7),
+    ("id", False, 1),
+    ("id", False, 1, 7, 8),
+])
+def test_forged_cursor_is_rejected(payload):
+    with pytest.raises(QueryError, match = "Invalid cursor"):
+        Query({"cursor": cursor(*payload)})
+
+def test_cursor_value_matches_order_by_column():
+    assert Query({"order_by": "name", "cursor": cursor("name", False, "mon1", 1)}).after == ("mon1", 1)
+    assert Query({"order_by": "name", "cursor": cursor("name", False, None, 1)}).after == (None, 1)
+    with pytest.raises(QueryError):
+        Query({"order_by": "name", "cursor": cursor("name", False, 5, 1)})
+
+def test_order_by_takes_one_minus():
+    assert Query({"order_by": "-hp"}).descending
+    with pytest.raises(QueryError):
+        Query({"order_by": "--hp"})
@@ -0,0 +1,109 @@
+import asyncio
+import multiprocessing
+import sys
+import types
+
+import aiosqlite
+import pytest
+
+import ratelimiter
+
+WORKERS = 8
+ATTEMPTS = 2000
+LIMIT = 50
+HOUR = 3600
+
+shm_only = pytest.mark.skipif(ratelimiter.fcntl is None, reason = "needs fcntl")
+
+
+def test_refill_never_refills_from_the_future():
+    assert ratelimiter.refill(0, 10.0, 5, 1, 9.0) == 0
+    assert ratelimiter.refill(1, 10.0, 5, 1, 10.5) == 3.5
+    assert ratelimiter.refill(4, 10.0, 5, 1, 20.0) == 5
+
+async def check_bucket(backend: ratelimiter.Backend):
+    keys = (("global", 100, HOUR), ("path", 3, HOUR))
+    assert [await backend.take(keys, 1) for _ in range(4)] == [None, None, None, 1]
+    # the path bucket denied, so the global one wasn't charged for it
+    assert int(await backend.peek("global", 100, HOUR)) == 97
+    assert int(await backend.peek("path", 3, HOUR)) == 0
+    assert await backend.take((("other", 3, HOUR),), 2) is None
+    assert await backend.take((("other", 3, HOUR),), 2) == 0
+    # never capped at the bucket size
+    assert await backend.take((("fresh", 3, HOUR),), 4) == 0
+
+def test_local_backend():
+    asyncio.run(check_bucket(ratelimiter.LocalBackend()))
+
+def test_redis_backend_with_local_store():
+    asyncio.run(check_bucket(ratelimiter.RedisBackend(ratelimiter.LocalStore())))
+
+def test_weight_counts_in_full():
+    async def main():
+        limiter = ratelimiter.Ratelimiter(types.SimpleNamespace())
+        limiter.app.account_db = db = await aiosqlite.connect(":memory:")
+        try:
+            await db.execute("CREATE TABLE accounts (api_key TEXT, key_type TINYINT)")
+            await db.execute("INSERT INTO accounts VALUES ('k', 0)")
+            limiter.set_limit("/api/pokemon/batch", 10, HOUR)
+            assert await limiter.process_request("/api/pokemon/batch", "k", 6) is None
+            assert await limiter.process_request("/api/pokemon/batch", "k", 5) is not None
+            assert await limiter.process_request("/api/pokemon/batch", "k", 4) is None
+            assert "costs more" in await limiter.process_request("/api/pokemon/batch", "k", 11)
+        finally:
+            await db.close()
+    asyncio.run(main())
+
+@shm_only
+def test_shared_memory_backend(tmp_path):
+    backend = ratelimiter.SharedMemoryBackend(str(tmp_path / "ratelimit"), 1024)
+    try:
+        asyncio.run(check_bucket(backend))
+    finally:
+        backend.close()
+
+@shm_only
+def test_shared_memory_backend_survives_clock_going_back(tmp_path, monkeypatch):
+    clock = [1_000_000.0]
+    monkeypatch.setattr(ratelimiter.time, "time", lambda: clock[0])
+    backend = ratelimiter.SharedMemoryBackend(str(tmp_path / "ratelimit"), 1024)
+    keys = (("path", 2, 1),)
+    try:
+        assert [backend._take(keys, 1) for _ in range(3)] == [None, None, 0]
+        # a reboot or clock step moves time far back, the drained bucket refills from there
+        clock[0] = 1000.0
+        assert backend._take(keys, 1) == 0
+        clock[0] = 1001.0
+        assert backend._take(keys, 1) is None
+    finally:
+        backend.close()
+
+def hammer(path: str, start, admitted):
+    backend = ratelimiter.SharedMemoryBackend(path, 1024)
+    keys = (("global", 10 ** 6, HOUR), ("path", LIMIT, HOUR))
+    start.wait()
+    count = 0
+    for _ in range(ATTEMPTS):
+        count += backend._take(keys, 1) is None
+    admitted.put(count)
+    backend.close()
+
+@shm_only
+@pytest.mark.parametrize("run", range(8))
+def test_shared_memory_backend_across_processes(tmp_path, run):
+    ctx = multiprocessing.get_context("fork")
+    path = str(tmp_path / "ratelimit")
+    start, admitted = ctx.Barrier(WORKERS), ctx.Queue()
+    workers = [ctx.Process(target = hammer, args = (path, start, admitted)) for _ in range(WORKERS)]
+    for w in workers:
+        w.start()
+    total = sum(admitted.get(timeout = 30) for _ in workers)
+    for w in workers:
+        w.join()
+    assert total == LIMIT
+
+def test_redis_backend_names_missing_package(monkeypatch):
+    monkeypatch.setitem(sys.modules, "redis", None)
+    monkeypatch.setitem(sys.modules, "redis.asyncio", None)
+    with pytest.raises(RuntimeError, match = "redis package"):
+        ratelimiter.make_backend("redis://localhost")
@@ -6,6 +6,7 @@ import json
 import time
 import base64
 import datetime
+import numpy
 
 def async_function(func: typing.Callable):
     @functools.wraps(func)
@@ -56,6 +57,10 @@ class Flags:
 
     __items__: typing.Dict[str, int]
     __settings__: typing.Dict[str, typing.Any]
+    __names__: typing.Optional[typing.Tuple[str, ...]]
+    __mask__: int
+    __width__: int
+    __mask_bits__: numpy.ndarray
 
     def __init__(self, value: int = 0, **flags):
         self.value: int = value
@@ -73,8 +78,73 @@ class Flags:
         else:
             raise TypeError(f"{flag} must be a bool, not {toggle.__class__!r}")
 
-    def _get_enabled_flags(self):
-        return [f for f in self.__items__.keys() if getattr(self, f, False)]
+    def _get_enabled_flags(self) -> typing.List[str]:
+        return self._decode(self.value)
+
+    @classmethod
+    def _decode(cls, value: int) -> typing.List[str]:
+        names = cls.__names__
+        if names is None:
+            return [f for f, v in cls.__items__.items() if value & v > 0]
+        # only walk the set bits, lowest first
+        value &= cls.__mask__
+        enabled = []
+        while value:
+            low = value & -value
+            enabled.append(names[low.bit_length() - 1])
+            value ^= low
+        return enabled
+
+    @classmethod
+    def bit_of(cls, name: str) -> typing.Optional[int]:
+        value = cls.__items__.get(name.strip().lower().replace("-", "_").replace(" ", "_"))
+        if value is None or value & (value - 1):
+            return None
+        return value.bit_length() - 1
+
+    @staticmethod
+    def from_db(value: typing.Union[bytes, int, str, "Flags", None]) -> int:
+        # flag columns are little-endian blobs, older databases hold decimal text
+        if value is None:
+            return 0
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return int.from_bytes(value, "little")
+        return int(value)
+
+    @classmethod
+    def to_bytes(cls, value: typing.Union[bytes, int, str, "Flags", None]) -> bytes:
+        # unknown bits are kept as long as they fit, they are masked out when decoding
+        width = cls.__width__
+        return (cls.from_db(value) & ((1 << width * 8) - 1)).to_bytes(width, "little")
+
+    @classmethod
+    def bit_matrix(cls, values: typing.Iterable[typing.Union[bytes, int, str, "Flags"]]) -> numpy.ndarray:
+        # one row per value, one uint8 0/1 column per bit, lowest bit first
+        width = cls.__width__
+        chunks = []
+        for v in values:
+            if isinstance(v, (bytes, bytearray, memoryview)) and len(v) == width:
+                # already in column format, hand it straight to numpy
+                chunks.append(bytes(v))
+            else:
+                chunks.append(cls.to_bytes(v))
+        bits = numpy.unpackbits(
+            numpy.frombuffer(b"".join(chunks), dtype = numpy.uint8).reshape(len(chunks), width),
+            axis = 1,
+            bitorder = "little",
+        )
+        bits &= cls.__mask_bits__
+        return bits
+
+    @classmethod
+    def decode_many(cls, values: typing.Iterable[typing.Union[bytes, int, str, "Flags"]]) -> typing.List[typing.List[str]]:
+        values = list(values)
+        if cls.__names__ is None or cls.__width__ == 0 or len(values) < 2:
+            return [cls._decode(cls.from_db(v)) for v in values]
+        rows, cols = numpy.nonzero(cls.bit_matrix(values))
+        found = cls.__name_array__[cols]
+        splits = numpy.cumsum(numpy.bincount(rows, minlength = len(values)))[:-1]
+        return [chunk.tolist() for chunk in numpy.split(found, splits)]
 
     def __init_subclass__(cls):
         items = dict()
@@ -88,6 +158,25 @@ class Flags:
 
         cls.__items__ = items
 
+        # bit -> name table, only usable when every flag is a single bit
+        mask = 0
+        for v in items.values():
+            mask |= v
+        cls.__mask__ = mask
+        cls.__width__ = (mask.bit_length() + 7) // 8
+        cls.__mask_bits__ = numpy.unpackbits(
+            numpy.frombuffer(mask.to_bytes(cls.__width__, "little"), dtype = numpy.uint8),
+            bitorder = "little",
+        )
+        if all(v > 0 and v & (v - 1) == 0 for v in items.values()):
+            names = [None] * mask.bit_length()
+            for k, v in items.items():
+                names[v.bit_length() - 1] = k
+            cls.__names__ = tuple(names)
+            cls.__name_array__ = numpy.array(names, dtype = object)
+        else:
+            cls.__names__ = None
+
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__} value={self.value}>"
 